@@ -1,7 +1,18 @@
+import io
 import sys
+import tarfile
 from subprocess import check_output
 
 
+def read_member(archive, name):
+    """
+        Return the decoded content of the member `name` of the tar file
+        `archive`.
+    """
+    with tarfile.open(archive) as tar:
+        return tar.extractfile(name).read().decode('utf-8')
+
+
 class TestMath:
 
     @classmethod
@@ -47,6 +58,91 @@ class TestMath:
              "https://fb1-7.bs.ptb.de/tiki/", "./test/math/math.tar"])
         assert (result == expected_lin or result == expected_win)
 
+    @staticmethod
+    def test_stdout_pipeline_call():
+        expected = check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", "-",
+             "https://fb1-7.bs.ptb.de/tiki/", "./test/math/math.tar"])
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", "-", "--workers", "2",
+             "--queue-size", "1", "https://fb1-7.bs.ptb.de/tiki/",
+             "./test/math/math.tar"])
+        assert result == expected
+
+    @staticmethod
+    def test_threads_call():
+        expected = check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", "-",
+             "https://fb1-7.bs.ptb.de/tiki/", "./test/math/math.tar"])
+        # on builds with the GIL the pages are converted serially instead
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", "-", "--threads", "2",
+             "--queue-size", "1", "https://fb1-7.bs.ptb.de/tiki/",
+             "./test/math/math.tar"])
+        assert result == expected
+
+    @staticmethod
+    def test_split_revisions_call():
+        expected = check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", "-",
+             "--identical-revisions", "collapse",
+             "https://fb1-7.bs.ptb.de/tiki/",
+             "./test/revisions/revisions.tar"])
+        # every page is split and its revisions converted as separate tasks
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", "-", "--workers", "2",
+             "--split-revisions", "1", "--identical-revisions", "collapse",
+             "https://fb1-7.bs.ptb.de/tiki/",
+             "./test/revisions/revisions.tar"])
+        assert result == expected
+        assert b'<id>2</id>\n<parentid>1</parentid>' in result
+
+    @staticmethod
+    def test_chunk_size_call():
+        for archive in ("./test/math/math.tar",
+                        "./test/images/Image testpage_width.tar"):
+            arguments = ["-k", "./test/images/testpage_images.xml", "-i",
+                         ".", "https://fb1-7.bs.ptb.de/tiki/", archive]
+            expected = check_output(
+                [sys.executable, "tikiToMwiki.py", "-o", "-"] + arguments)
+            result = check_output(
+                [sys.executable, "tikiToMwiki.py", "-o", "-",
+                 "--chunk-size", "16"] + arguments)
+            assert result == expected
+
+    @staticmethod
+    def test_incremental_call():
+        for archive in ("./test/revisions/revisions.tar",
+                        "./test/math/math.tar",
+                        "./test/images/Image testpage_width.tar"):
+            arguments = ["-k", "./test/images/testpage_images.xml", "-i",
+                         ".", "https://fb1-7.bs.ptb.de/tiki/", archive]
+            expected = check_output(
+                [sys.executable, "tikiToMwiki.py", "-o", "-"] + arguments)
+            result = check_output(
+                [sys.executable, "tikiToMwiki.py", "-o", "-",
+                 "--incremental"] + arguments)
+            assert result == expected
+
+    @staticmethod
+    def test_page_selection_call(tmp_path):
+        def convert(*selection):
+            return check_output(
+                [sys.executable, "tikiToMwiki.py", "-o", "-"]
+                + list(selection) + ["https://fb1-7.bs.ptb.de/tiki/",
+                                     "./test/math/math.tar"]).decode()
+
+        pagelist = tmp_path / "pages.txt"
+        pagelist.write_text("Math testpage\n", encoding='utf-8')
+        assert '<title>Math testpage</title>' in convert("--include", "M*")
+        assert '<title>Math testpage</title>' in convert(
+            "--include", "re:test", "--exclude", "*Image*")
+        assert '<title>Math testpage</title>' in convert(
+            "--pages-from", str(pagelist))
+        assert '<page>' not in convert("--include", "Image*")
+        assert '<page>' not in convert(
+            "--pages-from", str(pagelist), "--exclude", "re:^Math")
+
 
 class TestImages:
 
@@ -150,3 +246,649 @@ class TestImages:
                    ' on these pages: dict_keys([])\r\n'
         expected = opening_string + string + ending_string
         return expected.replace('\r\n', '\n').encode(), expected.encode()
+
+
+class TestSummary:
+
+    @classmethod
+    def teardown_class(cls):
+        """
+            This method deletes all files created during the tests with
+            filenames './test/math/summary_*.json'.
+        """
+        from glob import glob
+        import os
+
+        for filename in glob("./test/math/summary_*.json"):
+            os.remove(filename)
+
+    @staticmethod
+    def test_summary_json_call():
+        import json
+
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", "-", "--progress",
+             "--summary-json", "./test/math/summary_math.json",
+             "https://fb1-7.bs.ptb.de/tiki/", "./test/math/math.tar"])
+        assert result.startswith(b'<mediawiki xml:lang="en">')
+        with open("./test/math/summary_math.json", encoding='utf-8') as f:
+            summary = json.load(f)
+        assert summary['pages'] == 1
+        assert summary['revisions'] == 1
+        assert summary['revisions_per_page'] == {'Math testpage': 1}
+        assert summary['contributors'] == ['mustermann']
+        assert summary['uploads'] == {}
+        assert summary['missing_attachments'] == []
+        assert summary['timings']['seconds'] >= 0
+
+    @staticmethod
+    def test_trace_memory_call():
+        import json
+
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", "-", "--trace-memory",
+             "--summary-json", "./test/math/summary_memory.json",
+             "https://fb1-7.bs.ptb.de/tiki/", "./test/math/math.tar"])
+        assert b'largest peaks of traced memory per page' in result
+        with open("./test/math/summary_memory.json", encoding='utf-8') as f:
+            summary = json.load(f)
+        peaks = summary['memory_peaks']['Math testpage']
+        assert set(peaks) == {'page', 'parse', 'html', 'inline', 'emit'}
+        assert peaks['page'] >= peaks['parse'] > 0
+
+
+class TestServer:
+
+    @staticmethod
+    def test_stdio_serve_call():
+        import json
+
+        page = read_member("./test/math/math.tar", "Math testpage")
+        requests = json.dumps({'page': page}) + '\n' \
+            + json.dumps({'text': '::centered::'}) + '\n' + 'no json\n'
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "--serve",
+             "https://fb1-7.bs.ptb.de/tiki/"], input=requests.encode())
+        responses = [json.loads(line) for line in result.splitlines()]
+        assert responses[0]['title'] == 'Math testpage'
+        assert responses[0]['xml'].startswith(
+            '<page>\n<title>Math testpage</title>\n<revision>\n<id>1</id>\n')
+        assert '&lt;macro:mathjax&gt;' in responses[0]['xml']
+        assert responses[1]['text'] == \
+            '__TOC__\n\n&lt;center&gt;centered&lt;/center&gt; '
+        assert 'error' in responses[2]
+
+    @staticmethod
+    def test_text_requests_call():
+        import json
+
+        requests = ''.join(
+            json.dumps({'text': '<a href="https://fb1-7.bs.ptb.de/tiki/'
+                                'tiki-download_file.php?fileId={}">file'
+                                '</a>'.format(file_id)}) + '\n'
+            for file_id in (1, 2))
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "--serve",
+             "https://fb1-7.bs.ptb.de/tiki/"], input=requests.encode())
+        responses = [json.loads(line) for line in result.splitlines()]
+        # every request reports only the uploads linked by its own text
+        assert [response['uploads'] for response in responses] == [
+            ['https://fb1-7.bs.ptb.de/tiki/tiki-download_file.php?fileId='
+             + str(file_id)] for file_id in (1, 2)]
+
+    @staticmethod
+    def test_socket_client_call(tmp_path):
+        import os
+        import time
+        from subprocess import Popen
+
+        socketpath = str(tmp_path / "convert.sock")
+        pagefile = tmp_path / "Math testpage"
+        pagefile.write_text(
+            read_member("./test/math/math.tar", "Math testpage"),
+            encoding='utf-8')
+        server = Popen([sys.executable, "tikiToMwiki.py", "--serve",
+                        "--socket", socketpath,
+                        "https://fb1-7.bs.ptb.de/tiki/"])
+        try:
+            for _ in range(100):
+                if os.path.exists(socketpath):
+                    break
+                time.sleep(0.05)
+            result = check_output(
+                [sys.executable, "tikiToMwikiClient.py", socketpath,
+                 str(pagefile)])
+        finally:
+            server.terminate()
+            server.wait()
+        assert result.replace(b'\r\n', b'\n').startswith(
+            b'<page>\n<title>Math testpage</title>\n')
+        assert result.replace(b'\r\n', b'\n').endswith(
+            b'</revision>\n</page>\n')
+
+
+class TestInlineMarkup:
+
+    @staticmethod
+    def convert(*texts):
+        """
+            Convert the TikiWiki markup of single revisions with the
+            conversion server and return the converted texts without the
+            table of contents.
+        """
+        import json
+
+        requests = ''.join(json.dumps({'text': text}) + '\n'
+                           for text in texts)
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "--serve",
+             "https://fb1-7.bs.ptb.de/tiki/"], input=requests.encode())
+        return [json.loads(line)['text'][len('__TOC__\n\n'):]
+                for line in result.splitlines()]
+
+    @staticmethod
+    def test_inline_markup():
+        result = TestInlineMarkup.convert(
+            '!!Heading\r\nnext line',
+            'some ::centered:: text',
+            '~~red:coloured~~ words',
+            'see http://example.org/it\'s here')
+        assert result == [
+            '==Heading==\n\nnext line ',
+            'some &lt;center&gt;centered&lt;/center&gt; text ',
+            "&lt;span style='color:red'&gt;coloured&lt;/span&gt; words ",
+            'see &lt;nowiki&gt;http://example.org/it&lt;/nowiki&gt;\''
+            '&lt;nowiki&gt;s&lt;/nowiki&gt; here ']
+
+
+class TestUrlMap:
+
+    @staticmethod
+    def test_url_map_call(tmp_path):
+        import json
+
+        urlmap = tmp_path / "urls.csv"
+        urlmap.write_text(
+            "http://intranet/wiki/,https://wiki.example.org/,prefix\n"
+            "http://intranet/wiki/Start,https://wiki.example.org/Main_Page\n",
+            encoding='utf-8')
+        requests = ''.join(json.dumps({'text': text}) + '\n' for text in (
+            '[http://intranet/wiki/Foo|foo]\n'
+            '[http://intranet/wiki/Start|start]\n[http://other/x|x]',
+            '<p><a href="http://intranet/wiki/Bar">bar</a></p>'))
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "--serve", "--url-map",
+             str(urlmap), "https://fb1-7.bs.ptb.de/tiki/"],
+            input=requests.encode())
+        tiki, html = [json.loads(line)['text']
+                      for line in result.splitlines()]
+        assert '[https://wiki.example.org/Foo foo]' in tiki
+        assert '[https://wiki.example.org/Main_Page start]' in tiki
+        assert '[http://other/x x]' in tiki
+        assert '[https://wiki.example.org/Bar bar]' in html
+
+    @staticmethod
+    def test_invalid_url_map_call(tmp_path):
+        import subprocess
+
+        urlmap = tmp_path / "urls.csv"
+        urlmap.write_text("# old wiki\nhttp://old/,http://new/\nhttp://old/\n",
+                          encoding='utf-8')
+        result = subprocess.run(
+            [sys.executable, "tikiToMwiki.py", "--serve", "--url-map",
+             str(urlmap), "https://fb1-7.bs.ptb.de/tiki/"],
+            input=b'', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert result.returncode != 0
+        assert (str(urlmap) + ':3: expected PREFIX,REPLACEMENT[,MODE]') \
+            .encode() in result.stderr
+
+
+class TestRules:
+
+    @staticmethod
+    def test_rules_call(tmp_path):
+        import json
+
+        rules = tmp_path / "rules.json"
+        rules.write_text(json.dumps([
+            {'open': '{BOX(', 'close': ')}', 'replace': r'<div>\1</div>'},
+            {'open': '{QUOTE(author=', 'close': ')}', 'separator': '|',
+             'replace': r'<blockquote>\2 (\1)</blockquote>'},
+            {'open': '{DATE', 'pattern': r'{DATE\((\d+)\)}',
+             'replace': r'<time>\1</time>'}]), encoding='utf-8')
+        request = json.dumps({'text': (
+            '{BOX(boxed text)}\n{QUOTE(author=Tiki|quoted)}\n{DATE(2019)}\n'
+            '{CODE(caption=&gt;sample)}x = 1{CODE}')}) + '\n'
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "--serve", "--rules",
+             str(rules), "https://fb1-7.bs.ptb.de/tiki/"],
+            input=request.encode())
+        text = json.loads(result)['text']
+        # the markup is escaped to be inserted into the XML
+        assert '&lt;div&gt;boxed text&lt;/div&gt;' in text
+        assert '&lt;blockquote&gt;quoted (Tiki)&lt;/blockquote&gt;' in text
+        assert '&lt;time&gt;2019&lt;/time&gt;' in text
+        assert '&lt;source&gt;x = 1&lt;/source&gt;' in text
+
+
+class TestIdenticalRevisions:
+
+    @staticmethod
+    def convert(mode):
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", "-",
+             "--identical-revisions", mode, "https://fb1-7.bs.ptb.de/tiki/",
+             "./test/revisions/revisions.tar"])
+        return result.replace(b'\r\n', b'\n').decode()
+
+    @staticmethod
+    def test_keep_identical_call():
+        result = TestIdenticalRevisions.convert('keep')
+        assert result.count('<revision>') == 3
+        assert result.count('Second text') == 2
+
+    @staticmethod
+    def test_drop_identical_call():
+        result = TestIdenticalRevisions.convert('drop')
+        assert result.count('<revision>') == 2
+        assert '<id>2</id>\n<parentid>1</parentid>\n' \
+               '<timestamp>2018-03-12T12:38:31Z</timestamp>' in result
+        assert '<id>1</id>\n<timestamp>2018-03-12T13:40:00Z</timestamp>\n' \
+               '<contributor><username>mustermann</username>' in result
+        assert 'musterfrau' not in result
+
+    @staticmethod
+    def test_collapse_identical_call():
+        result = TestIdenticalRevisions.convert('collapse')
+        assert result.count('<revision>') == 2
+        assert '<id>1</id>\n<timestamp>2018-03-12T14:38:31Z</timestamp>\n' \
+               '<contributor><username>musterfrau</username></contributor>' \
+               '\n<comment>2 identical revisions collapsed</comment>\n' \
+               in result
+
+
+class TestCatalog:
+
+    @staticmethod
+    def test_catalog_call(tmp_path):
+        import json
+
+        catalog = str(tmp_path / "catalog.sqlite")
+        check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", str(tmp_path / "a.xml"),
+             "--catalog", catalog, "-k", "./test/images/testpage_images.xml",
+             "-i", ".", "https://fb1-7.bs.ptb.de/tiki/",
+             "./test/images/Image testpage.tar"])
+        # neither the image XML nor the first archive are given anymore
+        link = '<a href="https://fb1-7.bs.ptb.de/tiki/tiki-index.php?' \
+               'page=image+testpage">the images</a>'
+        requests = json.dumps({'text': link}) + '\n' \
+            + json.dumps({'text': '{img fileId="99999"}'}) + '\n'
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "--serve", "--catalog",
+             catalog, "-i", ".", "https://fb1-7.bs.ptb.de/tiki/"],
+            input=requests.encode())
+        responses = [json.loads(line) for line in result.splitlines()]
+        assert '[[Image testpage the images]]' in responses[0]['text']
+        assert responses[1]['text'].endswith('[[File:Xwiki-logo.png]]')
+        assert responses[1]['missing_attachments'] == []
+
+
+class TestAnalysis:
+
+    @staticmethod
+    def test_analyze_call(tmp_path):
+        import json
+
+        summary = tmp_path / "analysis.json"
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "--analyze", "--sample", "1",
+             "--summary-json", str(summary), "https://fb1-7.bs.ptb.de/tiki/",
+             "./test/math/math.tar"]).decode()
+        assert result.startswith('number of pages = 1 number of versions = 1')
+        analysis = json.loads(summary.read_text(encoding='utf-8'))
+        assert analysis['pages'] == 1
+        assert analysis['revisions'] == 1
+        assert analysis['html_revisions'] == 0
+        assert analysis['tiki_revisions'] == 1
+        assert analysis['constructs'] == {
+            'img': 0, 'links': 0, 'code': 0, 'html': 1, 'nowiki': 0}
+        assert analysis['sample']['pages'] == 1
+
+
+class TestTimeBudget:
+
+    @staticmethod
+    def test_time_budget_call():
+        import json
+
+        # a lot of underlined text which would take long to convert
+        pathological = '=== underlined === ' * 20000
+        requests = json.dumps({'text': pathological}) + '\n' \
+            + json.dumps({'text': '::centered::'}) + '\n'
+        result = check_output(
+            [sys.executable, "tikiToMwiki.py", "--serve", "--time-budget",
+             "0.05", "https://fb1-7.bs.ptb.de/tiki/"],
+            input=requests.encode())
+        responses = [json.loads(line) for line in result.splitlines()]
+        assert responses[0]['text'] == \
+            '&lt;nowiki&gt;' + pathological + '&lt;/nowiki&gt;'
+        assert responses[1]['text'] == \
+            '__TOC__\n\n&lt;center&gt;centered&lt;/center&gt; '
+
+
+class TestValidation:
+
+    @staticmethod
+    def test_validate_xml_call(tmp_path):
+        import subprocess
+
+        def validate(archive):
+            return subprocess.run(
+                [sys.executable, "tikiToMwiki.py", "-o",
+                 str(tmp_path / "out.xml"), "--validate-xml",
+                 "https://fb1-7.bs.ptb.de/tiki/", archive],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        assert validate("./test/math/math.tar").returncode == 0
+        # an author which isn't escaped breaks the second revision
+        page = read_member("./test/revisions/revisions.tar",
+                           "Revisions testpage")
+        archive = tmp_path / "broken.tar"
+        with tarfile.open(str(archive), "w") as pages:
+            data = page.replace('author=mustermann;',
+                                'author=muster<mann;').encode('utf-8')
+            member = tarfile.TarInfo("Revisions testpage")
+            member.size = len(data)
+            pages.addfile(member, io.BytesIO(data))
+        result = validate(str(archive))
+        assert result.returncode == 1
+        assert b'The XML of revision 3 of the page "Revisions testpage" is ' \
+               b'not well-formed' in result.stderr
+
+
+class TestShards:
+
+    @staticmethod
+    def test_shard_merge_call(tmp_path):
+        import json
+        import re
+
+        # an archive with the pages of the math, revisions and image tests
+        archive = str(tmp_path / "pages.tar")
+        with tarfile.open(archive, "w") as pages:
+            for name in ("./test/math/math.tar",
+                         "./test/revisions/revisions.tar",
+                         "./test/images/Image testpage.tar"):
+                with tarfile.open(name) as source:
+                    for member in source:
+                        pages.addfile(member, source.extractfile(member))
+
+        def convert(output, *shard):
+            check_output(
+                [sys.executable, "tikiToMwiki.py", "-o", str(output),
+                 "--summary-json", str(output) + ".json"] + list(shard)
+                + ["https://fb1-7.bs.ptb.de/tiki/", archive])
+
+        def pages(output):
+            return re.findall(r'<page>\n.*?</page>\n',
+                              output.read_text(encoding='utf-8'), re.S)
+
+        convert(tmp_path / "all.xml")
+        expected = pages(tmp_path / "all.xml")
+        for method in ("hash", "size"):
+            shards = [tmp_path / (method + str(index) + ".xml")
+                      for index in (1, 2)]
+            for index, shard in enumerate(shards, 1):
+                convert(shard, "--shard", "{}/2".format(index),
+                        "--shard-by", method)
+            merged = tmp_path / (method + ".xml")
+            check_output(
+                [sys.executable, "tikiToMwiki.py", "merge", "-o",
+                 str(merged), "--summary-json", str(merged) + ".json"]
+                + [str(shard) for shard in shards]
+                + [str(shard) + ".json" for shard in shards])
+            result = pages(merged)
+            assert sorted(result) == sorted(expected)
+            titles = [re.search('<title>(.*)</title>', page).group(1)
+                      for page in result]
+            assert titles == sorted(titles)
+            with open(str(merged) + ".json", encoding='utf-8') as summary:
+                summary = json.load(summary)
+            assert summary['pages'] == 3
+            assert set(summary['revisions_per_page']) == set(titles)
+
+    @staticmethod
+    def test_crlf_shard_merge_call(tmp_path):
+        shards = []
+        for name in ("./test/math/math.tar",
+                     "./test/revisions/revisions.tar"):
+            shard = tmp_path / (str(len(shards)) + ".xml")
+            check_output(
+                [sys.executable, "tikiToMwiki.py", "-o", str(shard),
+                 "https://fb1-7.bs.ptb.de/tiki/", name])
+            shards.append(shard)
+        # the first shard as written on Windows
+        shards[0].write_bytes(
+            shards[0].read_bytes().replace(b'\r\n', b'\n')
+            .replace(b'\n', b'\r\n'))
+        merged = tmp_path / "merged.xml"
+        check_output(
+            [sys.executable, "tikiToMwiki.py", "merge", "-o", str(merged)]
+            + [str(shard) for shard in shards])
+        result = merged.read_bytes().replace(b'\r\n', b'\n')
+        assert result.count(b'<page>\n') == 2
+        assert result.index(b'<title>Math testpage</title>') \
+            < result.index(b'<title>Revisions testpage</title>')
+        assert result.count(b'</mediawiki>') == 1
+        assert result.endswith(b'</page>\n</mediawiki>\n')
+
+
+class TestXar:
+
+    @staticmethod
+    def apply_rcs_delta(lines, delta):
+        """
+            Apply an RCS delta to the lines of the newer text and return the
+            lines of the older text.
+        """
+        result = []
+        position = 0
+        commands = delta.splitlines(True)
+        index = 0
+        while index < len(commands):
+            command, count = commands[index][1:].split()
+            line, count = int(command), int(count)
+            if commands[index][0] == 'd':
+                result.extend(lines[position:line - 1])
+                position = line - 1 + count
+                index += 1
+            else:
+                result.extend(lines[position:line])
+                position = max(position, line)
+                result.extend(commands[index + 1:index + 1 + count])
+                index += 1 + count
+        return result + lines[position:]
+
+    @staticmethod
+    def test_xar_call(tmp_path):
+        import re
+        import zipfile
+        from xml.dom import minidom
+
+        package = str(tmp_path / "revisions.xar")
+        check_output(
+            [sys.executable, "tikiToMwiki.py", "-o", package, "--format",
+             "xar", "--xar-space", "Tiki", "https://fb1-7.bs.ptb.de/tiki/",
+             "./test/revisions/revisions.tar"])
+        with zipfile.ZipFile(package) as xar:
+            files = minidom.parseString(xar.read("package.xml")) \
+                .getElementsByTagName('file')
+            references = [node.firstChild.data for node in files]
+            assert references == ['Tiki.Revisions testpage']
+            document = minidom.parseString(
+                xar.read('documents/Tiki.Revisions%20testpage.xml'))
+        assert document.getElementsByTagName('version')[0] \
+            .firstChild.data == '1.3'
+        assert document.getElementsByTagName('syntaxId')[0] \
+            .firstChild.data == 'mediawiki/1.6'
+
+        # restore all versions from the RCS archive of the history
+        history = document.getElementsByTagName('versions')[0] \
+            .firstChild.data
+        texts = dict(re.findall(r'\n\n(1\.\d+)\nlog\n@@\ntext\n@(.*?)@\n',
+                                history, re.S))
+        assert sorted(texts) == ['1.1', '1.2', '1.3']
+        lines = texts['1.3'].replace('@@', '@').splitlines(True)
+        for version in ('1.2', '1.1'):
+            lines = TestXar.apply_rcs_delta(
+                lines, texts[version].replace('@@', '@'))
+            older = minidom.parseString(''.join(lines).encode('utf-8'))
+            assert older.getElementsByTagName('version')[0] \
+                .firstChild.data == version
+
+    @staticmethod
+    def test_xar_stdout_call():
+        import subprocess
+        import zipfile
+
+        result = subprocess.run(
+            [sys.executable, "tikiToMwiki.py", "-o", "-", "--format", "xar",
+             "https://fb1-7.bs.ptb.de/tiki/",
+             "./test/revisions/revisions.tar"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert result.returncode == 0
+        # the package ends with its end of central directory record and the
+        # summary is written to stderr
+        assert result.stdout[-22:].startswith(b'PK\x05\x06')
+        with zipfile.ZipFile(io.BytesIO(result.stdout)) as xar:
+            assert 'package.xml' in xar.namelist()
+        assert b'number of pages = 1' in result.stderr
+
+
+class TestTables:
+
+    @staticmethod
+    def load_table(connection, directory, table, columns):
+        """
+            Load a bulk-load table written by `--format tables` into SQLite
+            as a stand-in for LOAD DATA.
+        """
+        import re
+
+        escapes = {'t': '\t', 'n': '\n', 'r': '\r', '0': '\0', '\\': '\\'}
+        connection.execute('CREATE TABLE {} ({})'.format(
+            table, ', '.join(columns)))
+        with open(str(directory / (table + '.tsv')), encoding='utf-8',
+                  newline='') as rows:
+            for row in rows.read().split('\n')[:-1]:
+                fields = [re.sub(r'\\(.)', lambda match: escapes[
+                    match.group(1)], field) for field in row.split('\t')]
+                assert len(fields) == len(columns)
+                connection.execute('INSERT INTO {} VALUES ({})'.format(
+                    table, ', '.join('?' * len(fields))), fields)
+
+    @staticmethod
+    def test_tables_call(tmp_path):
+        import hashlib
+        import sqlite3
+        from xml.dom import minidom
+
+        arguments = ["--identical-revisions", "collapse",
+                     "https://fb1-7.bs.ptb.de/tiki/",
+                     "./test/revisions/revisions.tar"]
+        check_output([sys.executable, "tikiToMwiki.py", "-o",
+                      str(tmp_path / "tables"), "--format", "tables"]
+                     + arguments)
+        check_output([sys.executable, "tikiToMwiki.py", "-o",
+                      str(tmp_path / "pages.xml")] + arguments)
+        xml = minidom.parse(str(tmp_path / "pages.xml"))
+        # the texts without the newline following the tag in the XML
+        texts = [text.firstChild.data[1:]
+                 for text in xml.getElementsByTagName('text')]
+
+        connection = sqlite3.connect(':memory:')
+        for table, columns in (
+                ('page', ['page_id', 'page_namespace', 'page_title',
+                          'page_is_redirect', 'page_is_new', 'page_random',
+                          'page_touched', 'page_latest', 'page_len']),
+                ('revision', ['rev_id', 'rev_page', 'rev_text_id',
+                              'rev_comment', 'rev_user', 'rev_user_text',
+                              'rev_timestamp', 'rev_minor_edit',
+                              'rev_deleted', 'rev_len', 'rev_parent_id',
+                              'rev_sha1']),
+                ('text', ['old_id', 'old_text', 'old_flags'])):
+            TestTables.load_table(connection, tmp_path / "tables", table,
+                                  columns)
+        assert connection.execute(
+            'SELECT page_id, page_title, page_latest, page_touched '
+            'FROM page').fetchall() == [
+            ('1', 'Revisions_testpage', '2', '20180312143831')]
+        revisions = connection.execute(
+            'SELECT rev_id, rev_parent_id, rev_user_text, rev_comment, '
+            'rev_len, rev_sha1, old_text FROM revision JOIN text '
+            'ON rev_text_id = old_id ORDER BY rev_id').fetchall()
+        assert [revision[:4] for revision in revisions] == [
+            ('1', '0', 'mustermann', ''),
+            ('2', '1', 'musterfrau', '2 identical revisions collapsed')]
+        # the texts are those of the XML with their lengths and SHA-1s
+        assert [revision[6] for revision in revisions] == texts
+        for revision in revisions:
+            text = revision[6].encode('utf-8')
+            assert int(revision[4]) == len(text)
+            assert int(revision[5], 36) == \
+                int(hashlib.sha1(text).hexdigest(), 16)
+
+
+class TestPages:
+
+    @staticmethod
+    def test_pages_call(tmp_path):
+        import hashlib
+        import os
+        import stat
+
+        arguments = ["-k", "./test/images/testpage_images.xml", "-i", ".",
+                     "https://fb1-7.bs.ptb.de/tiki/", "./test/math/math.tar"]
+        check_output([sys.executable, "tikiToMwiki.py", "-o",
+                      str(tmp_path / "pages"), "--format", "pages",
+                      "--workers", "2"] + arguments)
+        check_output([sys.executable, "tikiToMwiki.py", "-o",
+                      str(tmp_path / "pages.xml")] + arguments)
+        expected = (tmp_path / "pages.xml").read_bytes()
+
+        header = b'<mediawiki xml:lang="en">\n<siteinfo>\n' \
+                 b'<base>https://fb1-7.bs.ptb.de/tiki/</base>\n</siteinfo>\n'
+        index = (tmp_path / "pages" / "index.tsv").read_text(
+            encoding='utf-8').splitlines()
+        assert len(index) == expected.count(b'<page>')
+        documents = []
+        for entry in index:
+            title, path, sha1 = entry.split('\t')
+            digest = hashlib.md5(title.encode('utf-8')).hexdigest()
+            assert path == digest[0] + '/' + digest[:2] + '/' + digest \
+                + '.xml'
+            document = (tmp_path / "pages" / path).read_bytes()
+            assert hashlib.sha1(document).hexdigest() == sha1
+            assert document.startswith(header)
+            assert document.endswith(b'</mediawiki>\n')
+            documents.append(document[len(header):-len(b'</mediawiki>\n')])
+        # the documents contain the pages of the XML in the order of the
+        # index
+        assert header + b''.join(documents) + b'</mediawiki>\n' == expected
+
+        # the files get the permissions of files created by open()
+        umask = os.umask(0)
+        os.umask(umask)
+        for path in (tmp_path / "pages").rglob('*.*'):
+            assert stat.S_IMODE(path.stat().st_mode) == 0o666 & ~umask
+
+        # unchanged documents aren't rewritten and no temporary files remain
+        modified = {path: path.stat().st_mtime_ns
+                    for path in (tmp_path / "pages").rglob('*.xml')}
+        check_output([sys.executable, "tikiToMwiki.py", "-o",
+                      str(tmp_path / "pages"), "--format", "pages"]
+                     + arguments)
+        assert {path: path.stat().st_mtime_ns
+                for path in (tmp_path / "pages").rglob('*.xml')} == modified
+        assert not list((tmp_path / "pages").rglob('*.tmp'))
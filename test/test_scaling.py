@@ -0,0 +1,124 @@
+import importlib.util
+import os
+import time
+
+# the sizes of the inputs compared, the conversion of the larger input may
+# take up to `limit` times longer, which fails for quadratic growth
+factor = 8
+limit = 20
+
+
+def load_converter():
+    """
+        Import the conversion script as a module configured with the image
+        lookup of the image tests.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(
+        "tikiToMwiki", os.path.join(root, "tikiToMwiki.py"))
+    converter = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(converter)
+    arguments = ["-k", os.path.join(root, "test", "images",
+                                    "testpage_images.xml"),
+                 "-i", ".", "https://fb1-7.bs.ptb.de/tiki/"]
+    (options, args) = converter.parser.parse_args(arguments)
+    converter.configure(options, args)
+    return converter
+
+
+converter = load_converter()
+
+
+def elapsed(function, argument):
+    """
+        Return the shortest time of three calls of `function(argument)`.
+    """
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def assert_linear(function, make_input, size):
+    """
+        Check that the time of `function` grows linearly with the size of
+        its input created by `make_input(size)`.
+    """
+    small = elapsed(function, make_input(size))
+    large = elapsed(function, make_input(size * factor))
+    assert large < limit * small, \
+        '{:.4f} s for size {} but {:.4f} s for size {}'.format(
+            small, size, large, size * factor)
+
+
+class TestScaling:
+
+    @staticmethod
+    def test_html_converter():
+        def convert(html):
+            converter.HTMLToMwiki().feed(html)
+
+        assert_linear(convert, lambda size: (
+            '<p><a href="https://example.org/x">a link</a> <b>bold</b> '
+            '<i>italic</i></p><ul><li>item</li></ul><h2>heading</h2>'
+            '<table><tr><td>cell</td><td>cell</td></tr></table>') * size,
+            200)
+
+    @staticmethod
+    def test_word_loop_lines():
+        assert_linear(converter.convert_inline, lambda size: (
+            '!!Heading\n'
+            'some ::centered:: text ~~red:coloured~~ words\n'
+            'see http://example.org/page for ~~blue: more~~\n'
+            'a plain line without any markup\n') * size, 200)
+
+    @staticmethod
+    def test_word_loop_dense_words():
+        # many constructs in single words without spaces
+        assert_linear(converter.convert_inline,
+                      lambda size: '::centered::' * size + '\n'
+                      + '~~red:coloured~~' * size + '\n'
+                      + '!' * size + 'heading\n', 500)
+
+    @staticmethod
+    def test_process_image():
+        assert_linear(converter.convert_inline, lambda size: (
+            '{img fileId="99999" width=20} text {img src="x?fileId=99999&'
+            'thumb=y"}\n') * size, 200)
+
+    @staticmethod
+    def test_insert_link():
+        def insert(words):
+            converter.state.words = []
+            converter.state.page = []
+            for word in words:
+                converter.insert_link(word)
+
+        assert_linear(insert, lambda size: ['((Some'] + ['word'] * size
+                      + ['page))'], 2000)
+
+    @staticmethod
+    def test_escaping_and_whitespace():
+        assert_linear(converter.convert_markup, lambda size: (
+            '!Heading\r\n===underlined===   text  with \x01 control and '
+            'spaces\r\n\r\n \r\n&lt;escaped&gt; &amp; | \r\n \r\n') * size,
+            500)
+
+    @staticmethod
+    def test_incremental_serve_caches():
+        # the caches of a server only keep the conversions of the previous
+        # request, however many requests it answers
+        converter.options.incremental = True
+        try:
+            for request in range(200):
+                response = converter.handle_request({'text': (
+                    '<p>block {0}</p>\nline {0}\n').format(request)})
+                assert 'error' not in response
+                assert len(converter.state.blocks) <= 8
+                assert len(converter.state.previousBlocks) <= 8
+                assert len(converter.state.lines) <= 8
+                assert len(converter.state.previousLines) <= 8
+        finally:
+            converter.options.incremental = False
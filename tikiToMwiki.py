@@ -18,25 +18,261 @@
 # © copyright PTB 2019, T. Bruns, B.Ludwig
 
 import ast
+import collections
+import concurrent.futures
+import csv
 import datetime
+import difflib
+import fnmatch
+import functools
+import hashlib
 import html.entities as htmlentitydefs
 import io
+import json
+import os
+import queue
+import random
 import re
+import signal
+import socketserver
+import sqlite3
 import sys
 import tarfile
+import tempfile
+import threading
 import time
+import tracemalloc
+import zipfile
+import zlib
 from email.parser import Parser
 from html.parser import HTMLParser
 from optparse import OptionParser
 from urllib.parse import quote, unquote, urljoin
+from xml.parsers import expat
 from xml.sax.saxutils import unescape, escape
 
 from defusedxml import minidom
 
-# add any other links you may want to map between wikis here
+# add any other links you may want to map between wikis here or in a file
+# given by --url-map
 url_maps = {'http://tikiwiki.org/RFCWiki':
                 'http://meta.wikimedia.org/wiki/Cheatsheet'}
 
+# Set opening tags to identify file attachments (images, pdfs, etc.).
+attachment_identifiers = ['{img', '{mediaplayer']
+
+# HTML entities to unescape before the conversion, but leave &amp;, &gt; and
+# &lt; escaped so they are not mistaken for markup
+unescape_entitydefs = dict(("&" + k + ";", chr(v)) for k, v in
+                           htmlentitydefs.name2codepoint.items())
+unescape_entitydefs.pop("&amp;")
+unescape_entitydefs.pop("&gt;")
+unescape_entitydefs.pop("&lt;")
+
+# characters to escape in the converted text, where the pipe would otherwise
+# be interpreted as a separator in MediaWiki templates and links
+escape_entitydefs = dict((chr(k), "&amp;" + v + ";") for k, v in
+                         htmlentitydefs.codepoint2name.items())
+escape_entitydefs.pop('<')
+escape_entitydefs.pop('>')
+escape_entitydefs.pop('&')
+escape_entitydefs['|'] = '&#124;'
+
+# the replacements of xml.sax.saxutils.unescape and escape with the entities
+# above in the order it applies them, to apply them to chunks of a revision
+unescape_replacements = [('&lt;', '<'), ('&gt;', '>')] \
+    + list(unescape_entitydefs.items()) + [('&amp;', '&')]
+escape_replacements = [('&', '&amp;'), ('>', '&gt;'), ('<', '&lt;')] \
+    + list(escape_entitydefs.items())
+
+# the characters ending lines as recognized by str.splitlines
+line_terminators = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+
+# control characters not allowed in the converted text except for newlines
+# and tabs
+control_characters = dict((code, '?') for code in range(32)
+                          if chr(code) not in '\n\r\t')
+
+# The configuration and lookup tables of the current conversion, which are
+# filled in main() or when serving conversions.
+sourceurl = ''
+imageurl = ''
+pages = []
+privatePages = []
+# the patterns and titles selecting the pages to convert
+includePatterns = []
+excludePatterns = []
+selectedPages = set()
+# the shard of the pages converted by this run counting from 0, the number
+# of shards and, if the shards are balanced by size, the shard's pages
+shardIndex = 0
+shardCount = 0
+shardPages = None
+imageFilenames = {}
+imageFileIDs = {}
+# the titles of the pages by their lower case titles
+pageTitles = {}
+# the optional SQLite catalog of pages and attachments across runs, which
+# is shared by all threads and only used while holding the lock
+catalog = None
+catalogLock = threading.Lock()
+
+
+class ConversionState(threading.local):
+    """
+    The state of the conversion running in the current thread, which allows
+    to convert several pages concurrently in threads.
+    """
+
+    def __init__(self):
+        # the page and revision currently converted, to be referenced in
+        # messages
+        self.title = ''
+        self.partcount = 0
+        self.uploads = []
+        self.missingAttachments = []
+        # the time by which the conversion of the current revision must be
+        # finished
+        self.deadline = None
+        # whether the HTMLChecker found HTML tags
+        self.validate = False
+        # the output of the inline conversion and the state of internal links
+        self.words = []
+        self.intLink = False
+        self.page = []
+        # with --incremental the converted HTML blocks and lines of the
+        # current and the previous revision by their text and the state of
+        # the conversion they start in
+        self.blocks = {}
+        self.previousBlocks = {}
+        self.lines = {}
+        self.previousLines = {}
+        # the peaks of traced memory of the current page by stage and the
+        # traced memory when its conversion started
+        self.memory = {}
+        self.memoryStart = 0
+
+
+state = ConversionState()
+
+
+class TimeBudgetExceeded(Exception):
+    """
+    Raised if the conversion of a revision takes longer than `--time-budget`.
+    """
+
+
+def check_deadline():
+    """
+    Stop the conversion of the current revision if it is over its time
+    budget. This is called in every iteration of the conversion loops, which
+    could take very long for pathological input.
+    """
+    if state.deadline is not None and time.monotonic() > state.deadline:
+        raise TimeBudgetExceeded()
+
+
+def memory_mark():
+    """
+    Start measuring the peak of traced memory of a stage of the conversion
+    if `--trace-memory` is set.
+
+    :return: the traced memory at the start of the stage or None if memory
+        isn't traced
+    """
+    if not options.tracememory:
+        return None
+    # before Python 3.9 the peak can't be reset and is the peak since the
+    # tracing started
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def memory_record(stage, mark):
+    """
+    Record the peak of traced memory allocated by a stage of the conversion
+    of the current page since :func:`memory_mark` returned `mark`, and the
+    peak of the whole page.
+
+    Memory is traced per process, so with `--threads` the peaks include
+    the allocations of the pages converted at the same time.
+    """
+    if mark is None:
+        return
+    peak = tracemalloc.get_traced_memory()[1]
+    state.memory[stage] = max(state.memory.get(stage, 0), peak - mark)
+    state.memory['page'] = max(state.memory.get('page', 0),
+                               peak - state.memoryStart)
+
+
+class UrlMap:
+    """
+    Rewrite the URLs of links by exact and prefix rules.
+
+    The rules are stored in a trie of the URLs' characters, so a URL is
+    rewritten in time proportional to its length regardless of the number
+    of rules. An exact rule takes precedence over prefix rules, and of
+    several matching prefix rules the longest prefix wins.
+    """
+
+    # keys of the rules in the trie's nodes, which can't be mistaken for
+    # the characters keying the child nodes
+    EXACT = 0
+    PREFIX = 1
+
+    def __init__(self, exact=None):
+        """
+        :param dict exact: URLs to replace by exact rules
+        """
+        self.root = {}
+        for source, target in (exact or {}).items():
+            self.add(source, target)
+
+    def add(self, source, target, prefix=False):
+        """
+        Add a rule replacing the URL `source` or, if `prefix` is set, the
+        beginning `source` of URLs by `target`.
+        """
+        node = self.root
+        for char in source:
+            node = node.setdefault(char, {})
+        node[self.PREFIX if prefix else self.EXACT] = target
+
+    def rewrite(self, url):
+        """
+        Return the URL rewritten by the matching rule or unchanged if no
+        rule matches.
+        """
+        node = self.root
+        # the replacement by the longest matching prefix and its length
+        match = None
+        for position, char in enumerate(url):
+            if self.PREFIX in node:
+                match = node[self.PREFIX], position
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            if self.EXACT in node:
+                return node[self.EXACT]
+            if self.PREFIX in node:
+                match = node[self.PREFIX], len(url)
+        if match is None:
+            return url
+        return match[0] + url[match[1]:]
+
+
+# the rules rewriting the URLs of links, extended by --url-map
+urlMap = UrlMap(url_maps)
+
+
+# the positions before tags starting a block or a line, where the HTML of a
+# revision is split into blocks
+html_blocks = re.compile(
+    r'(?=<)(?:(?<=\n)'
+    r'|(?=<(?:p|div|h[1-6]|ul|ol|li|table|tr|pre|blockquote|br)\b))')
+
 
 # checks for HTML tags
 class HTMLChecker(HTMLParser):
@@ -46,12 +282,10 @@ class HTMLChecker(HTMLParser):
     # https://bugs.python.org/issue31844)
 
     def handle_starttag(self, tag, attrs):
-        global validate
-        validate = True
+        state.validate = True
         return True
 
     def handle_endtag(self, tag):
-        global validate
         return True
 
 
@@ -60,53 +294,77 @@ class HTMLChecker(HTMLParser):
 # that do/don't start a new line in HTML can be controlled by the CSS. The
 # CSS used depends on which skin you're using.
 class HTMLToMwiki(HTMLParser):
-    global wikitext
-    global sourceurl
-    global pages
-    global uploads
-    global headings
-    # if the parser is within a link
-    link = False
-    src = ''
-    innowiki = False
-    # if the parser is within italics
-    inem = False
-    # if the parser is within bold
-    instrong = False
-    # if the parser is within a heading
-    inheading = False
-    # whether the parser is within an ordered list (is numeric to deal with
-    # nested lists)
-    list = 0
-    # whether the parser is within a list item - in order to deal with <p>
-    # and <br/> tags in ways that wont break it
-    litem = 0
-    # the number of ul tags used for nested lists
-    ul_count = 0
-    # the number of ol tags used for nested lists
-    ol_count = 0
-    col_count = 0
+
+    def __init__(self):
+        # the converted text
+        self.wikitext = []
+        self.headings = []
+        # if the parser is within a link
+        self.link = False
+        self.src = ''
+        self.innowiki = False
+        # if the parser is within italics
+        self.inem = False
+        # if the parser is within bold
+        self.instrong = False
+        # if the parser is within a heading
+        self.inheading = False
+        # whether the parser is within an ordered list (is numeric to deal
+        # with nested lists)
+        self.list = 0
+        # whether the parser is within a list item - in order to deal with
+        # <p> and <br/> tags in ways that wont break it
+        self.litem = 0
+        # the number of ul tags used for nested lists
+        self.ul_count = 0
+        # the number of ol tags used for nested lists
+        self.ol_count = 0
+        self.col_count = 0
+        super().__init__()
+
+    def context(self):
+        """
+        Get the state the conversion of the following text depends on.
+
+        :return: a tuple of the state or None if the parser holds back input
+            which it has not processed yet
+        """
+        if self.rawdata or self.cdata_elem is not None:
+            return None
+        # check_append only looks at which of the last entries are newlines
+        return (self.link, self.src, self.innowiki, self.inem, self.instrong,
+                self.inheading, self.list, self.litem, self.ul_count,
+                self.ol_count, self.col_count,
+                tuple(entry == '\n' for entry in self.wikitext[-3:]))
+
+    def restore(self, context):
+        """
+        Continue the conversion in a state returned by :meth:`context`.
+        """
+        (self.link, self.src, self.innowiki, self.inem, self.instrong,
+         self.inheading, self.list, self.litem, self.ul_count, self.ol_count,
+         self.col_count) = context[:-1]
 
     def handle_starttag(self, tag, attrs):
+        check_deadline()
         if self.innowiki:
             complete_tag = '<' + tag
             for attr in attrs:
                 complete_tag += ' ' + attr[0] + '="' + attr[1] + '"'
-            wikitext.append(complete_tag + '>')
+            self.wikitext.append(complete_tag + '>')
         else:
             if tag == 'nowiki':
-                wikitext.append('<nowiki>')
+                self.wikitext.append('<nowiki>')
                 self.innowiki = True
             if tag == 'a':
                 self.src = ''
                 for att in attrs:
                     if att[0] == 'href':
                         self.src = att[1]
-                if self.src in url_maps:
-                    self.src = url_maps[self.src]
+                self.src = urlMap.rewrite(self.src)
                 # deals with uploads
                 if 'tiki-download_file.php' in self.src:
-                    uploads.append(self.src)
+                    state.uploads.append(self.src)
                 self.link = True
             if tag == 'ol':
                 self.ol_count += 1
@@ -119,9 +377,9 @@ class HTMLToMwiki(HTMLParser):
                 # nesting
                 self.litem += 1
                 if self.list > 0:
-                    wikitext.append('\n' + ('#' * self.ol_count))
+                    self.wikitext.append('\n' + ('#' * self.ol_count))
                 else:
-                    wikitext.append('\n' + ('*' * self.ul_count))
+                    self.wikitext.append('\n' + ('*' * self.ul_count))
             if tag == 'img':
                 src = ''
                 for att in attrs:
@@ -136,29 +394,29 @@ class HTMLToMwiki(HTMLParser):
                         options.newImagepath, src.split('/')[-1])
                 # the pic tag is used later to identify this as a picture and
                 # process the correct MediaWiki syntax
-                wikitext.append('<pic>' + imagepath + ' ')
+                self.wikitext.append('<pic>' + imagepath + ' ')
             if tag == 'table':
-                wikitext.append('\n{|')
+                self.wikitext.append('\n{|')
                 for att in attrs:
                     # table formatting
-                    wikitext.append(' ' + att[0] + '="' + att[1] + '"')
+                    self.wikitext.append(' ' + att[0] + '="' + att[1] + '"')
             if tag == 'tr':
-                wikitext.append('\n|-')
+                self.wikitext.append('\n|-')
                 self.col_count = 0
             if tag == 'td':
                 self.col_count += 1
                 if self.col_count > 1:
-                    wikitext.append('\n||')
+                    self.wikitext.append('\n||')
                 else:
-                    wikitext.append('\n|')
+                    self.wikitext.append('\n|')
             if tag == 'caption':
-                wikitext.append('\n|+')
+                self.wikitext.append('\n|+')
             if tag in ('strong', 'b'):
                 self.instrong = True
-                wikitext.append("'''")
+                self.wikitext.append("'''")
             if tag in ('em', 'i'):
                 self.inem = True
-                wikitext.append("''")
+                self.wikitext.append("''")
             if tag == 'p':
                 # new lines in the middle of lists break the list so we have
                 # to use the break tag
@@ -173,59 +431,59 @@ class HTMLToMwiki(HTMLParser):
                     br = "''" + br + br + "''"
                 if self.instrong:
                     br = "'''" + br + br + "'''"
-                wikitext.append(br)
+                self.wikitext.append(br)
             if tag == 'h1':
                 self.inheading = True
                 # headings must start on a new line
-                wikitext.append('\n\n==')
-                headings.append(tag)
+                self.wikitext.append('\n\n==')
+                self.headings.append(tag)
             if tag == 'h2':
                 self.inheading = True
-                wikitext.append('\n\n===')
-                headings.append(tag)
+                self.wikitext.append('\n\n===')
+                self.headings.append(tag)
             if tag == 'h3':
                 self.inheading = True
-                wikitext.append('\n\n====')
-                headings.append(tag)
+                self.wikitext.append('\n\n====')
+                self.headings.append(tag)
             else:
-                wikitext.append('<' + tag + '>')
+                self.wikitext.append('<' + tag + '>')
 
     def handle_endtag(self, tag):
         if tag == 'nowiki':
-            wikitext.append('</nowiki>')
+            self.wikitext.append('</nowiki>')
             self.innowiki = False
         if not self.innowiki:
             if self.link:
                 self.src = ''
                 self.link = False
             if tag == 'img':
-                wikitext.append('</pic>')
+                self.wikitext.append('</pic>')
             if tag == 'ol':
                 self.ol_count -= 1
                 self.list -= 1
-                wikitext.append('\n\n')
+                self.wikitext.append('\n\n')
             if tag == 'ul':
                 self.ul_count -= 1
-                wikitext.append('\n\n')
+                self.wikitext.append('\n\n')
             if tag == 'li':
                 self.litem -= 1
             if tag == 'table':
-                wikitext.append('\n\n|}')
+                self.wikitext.append('\n\n|}')
             if tag in ('strong', 'b'):
                 self.instrong = False
-                wikitext.append("'''")
+                self.wikitext.append("'''")
             if tag in ('em', 'i'):
                 self.inem = False
-                wikitext.append("''")
+                self.wikitext.append("''")
             if tag == 'h1':
                 self.inheading = False
-                wikitext.append('==\n\n')
+                self.wikitext.append('==\n\n')
             if tag == 'h2':
                 self.inheading = False
-                wikitext.append('===\n\n')
+                self.wikitext.append('===\n\n')
             if tag == 'h3':
                 self.inheading = False
-                wikitext.append('====\n\n')
+                self.wikitext.append('====\n\n')
             if tag == 'p':
                 if self.inheading:
                     br = ''
@@ -237,7 +495,7 @@ class HTMLToMwiki(HTMLParser):
                     br = " ''" + br + "''"
                 if self.instrong:
                     br = " '''" + br + "'''"
-                wikitext.append(br)
+                self.wikitext.append(br)
             if tag == 'br':
                 if self.inheading:
                     br = ''
@@ -249,21 +507,20 @@ class HTMLToMwiki(HTMLParser):
                     br = " ''" + br + "''"
                 if self.instrong:
                     br = " '''" + br + "'''"
-                wikitext.append(br)
+                self.wikitext.append(br)
             if tag == 'hr':
-                wikitext.append('\n----\n')
+                self.wikitext.append('\n----\n')
             else:
-                wikitext.append('</' + tag + '>')
+                self.wikitext.append('</' + tag + '>')
         else:
-            wikitext.append('</' + tag + '>')
+            self.wikitext.append('</' + tag + '>')
 
     # check for symbols which are MediaWiki syntax when at the start of a line
-    @staticmethod
-    def check_append(data):
+    def check_append(self, data):
         stripped = data.lstrip()
         for symbol in ('----', '*', '#', '{|', '==', '===', '===='):
             if stripped.startswith(symbol):
-                if len(wikitext) > 2 and wikitext[-3] == '\n':
+                if len(self.wikitext) > 2 and self.wikitext[-3] == '\n':
                     if not symbol.startswith('='):
                         data = '<nowiki>' + symbol + '</nowiki>' \
                                + stripped[len(symbol):]
@@ -274,6 +531,7 @@ class HTMLToMwiki(HTMLParser):
         return data
 
     def handle_data(self, data):
+        check_deadline()
         if self.link:
             # sometimes spaces are in the piped data (probably because of our
             # editor) so we need to make sure we add that before the link
@@ -281,50 +539,99 @@ class HTMLToMwiki(HTMLParser):
             if data.startswith(' '):
                 space = ' '
             if self.src.startswith(sourceurl + 'tiki-download_file.php'):
-                wikitext.append(space + '[' + self.src + ' ' + data + ']')
+                self.wikitext.append(space + '[' + self.src + ' ' + data + ']')
             elif self.src.startswith(sourceurl):
                 if 'page=' in self.src:
                     ptitle = self.src.split('page=')
                     pagename = ptitle[1].replace('+', ' ')
-                    for file in pages:
-                        # MediaWiki is case sensitive to page names and
-                        # TikiWiki isn't so check that the file actually exists
-                        if file.lower() == pagename.lower():
-                            pagename = file
-                    wikitext.append(space + '[[' + pagename + '|' + data
+                    # MediaWiki is case sensitive to page names and
+                    # TikiWiki isn't so check that the file actually exists
+                    pagename = canonical_title(pagename)
+                    self.wikitext.append(space + '[[' + pagename + '|' + data
                                     + ']]')
             else:
                 # catch relative urls
                 if self.src.startswith('..'):
                     self.src = urljoin(sourceurl, self.src)
-                wikitext.append(space + '[' + self.src + ' ' + data + ']')
+                self.wikitext.append(space + '[' + self.src + ' ' + data + ']')
         elif self.litem:
             # if we're in a list put nowiki tags around data beginning with *
             # or # so it isn't counted as nesting
             if data[0] in ('*', '#'):
                 data = '<nowiki>' + data[0] + '</nowiki>' + data[1:]
-            wikitext.append(data)
+            self.wikitext.append(data)
         else:
             data = self.check_append(data)
-            wikitext.append(data)
+            self.wikitext.append(data)
 
     def handle_entityref(self, name):
         name = "&amp;" + name + ";"
         if self.link:
-            wikitext.append(' ' + name)
+            self.wikitext.append(' ' + name)
         elif self.litem:
-            wikitext.append(name)
+            self.wikitext.append(name)
         else:
-            wikitext.append(name)
+            self.wikitext.append(name)
 
     def handle_charref(self, name):
         name = "&amp;" + name + ";"
         if self.link:
-            wikitext.append(' ' + name)
+            self.wikitext.append(' ' + name)
         elif self.litem:
-            wikitext.append(name)
+            self.wikitext.append(name)
         else:
-            wikitext.append(name)
+            self.wikitext.append(name)
+
+
+def set_pages(names):
+    """
+    Set the names of the pages, which are linked with the correct case.
+
+    :param list[str] names: the titles of all pages in the exported tar file
+    """
+    global pages
+    global pageTitles
+    pages = names
+    # the last page of several differing only in case wins
+    pageTitles = dict((name.lower(), name) for name in names)
+
+
+def canonical_title(name):
+    """
+    Return the title of the existing page `name` is referring to, because
+    MediaWiki is case sensitive to page names and TikiWiki isn't.
+
+    :param str name: the page name as linked in TikiWiki
+    :return: the title of the page or `name` if no such page is known
+    """
+    if catalog is not None:
+        with catalogLock:
+            row = catalog.execute(
+                'SELECT title FROM pages WHERE folded = ? '
+                'ORDER BY rowid DESC LIMIT 1', (name.casefold(),)).fetchone()
+        if row is not None:
+            return row[0]
+    return pageTitles.get(name.lower(), name)
+
+
+def attachment_path(file_id):
+    """
+    Look up the path of an attachment in the image XML or the catalog.
+
+    :param str file_id: the TikiWiki file ID of the attachment
+    :return: the path of the attachment
+    :raises KeyError: if the attachment is unknown
+    """
+    if file_id in imageFileIDs:
+        return imageFileIDs[file_id]
+    if catalog is not None:
+        with catalogLock:
+            row = catalog.execute(
+                'SELECT path FROM attachments WHERE file_id = ?',
+                (file_id,)).fetchone()
+        if row is not None:
+            return row[0]
+    raise KeyError(file_id)
 
 
 def process_image(word, attachment_identifiers):
@@ -375,22 +682,25 @@ def process_image(word, attachment_identifiers):
         # Return error message in case the mentioned file is not anymore
         # an attachment in the current revision.
         try:
-            filename = imageFileIDs[file_id]
+            filename = attachment_path(file_id)
             if options.verbose_mode:
                 sys.stdout.write(
                     'The attachment with ID ' + file_id
-                    + ' was successfully added to revision ' + str(partcount)
-                    + ' of the page "' + title + '"\n')
+                    + ' was successfully added to revision '
+                    + str(state.partcount) + ' of the page "' + state.title
+                    + '"\n')
         except KeyError:
             sys.stderr.write('The attachment with ID ' + file_id
                              + ' doesn\'t exist in your specified XML '
                                'file and won\'t be displayed properly\n')
+            if file_id not in state.missingAttachments:
+                state.missingAttachments.append(file_id)
             filename = file_id
         filename = quote(filename)
         imagepath = urljoin(imageurl, filename)
         if options.newImagepath != '':
             imagepath = urljoin(options.newImagepath, filename)
-        words.append('[[File:' + imagepath)
+        state.words.append('[[File:' + imagepath)
     for identifier in data_identifiers:
         if identifier in word:
             # Find position and length of the data for either short
@@ -405,28 +715,28 @@ def process_image(word, attachment_identifiers):
             if 'width' in word:
                 if '%' in word:
                     # Append percentage to the current tag.
-                    words.append('|upright 1.0')
+                    state.words.append('|upright 1.0')
                 else:
                     if 'px' in data:
                         # Append width and separator to the current tag.
-                        words.append('|' + data)
+                        state.words.append('|' + data)
                     else:
                         # Append width, its unit and separator to the current
                         # tag.
-                        words.append('|' + data + 'px')
+                        state.words.append('|' + data + 'px')
             # Append a specific small width to the tag for images previously
             # marked as thumbnails to show in big if mouse is over them.
             if 'thumb=' in word:
-                words.append('|70px')
+                state.words.append('|70px')
     # Close new attachment tag.
     if '}' in word:
         # Insert an extra space in case the old attachment tag did not end on
         # space.
         closing_brackets_index = word.find('}')
         if word[-1] != '}' and word[closing_brackets_index + 1] != ' ':
-            words.append(']] ')
+            state.words.append(']] ')
         else:
-            words.append(']]')
+            state.words.append(']]')
 
         # Stop processing attachment conversion in case it is really finished in
         # the current line and continue in case of multiple attachments in one
@@ -435,59 +745,1685 @@ def process_image(word, attachment_identifiers):
         if not any(tag in word for tag in attachment_identifiers):
             still_processing = False
 
-    return words, still_processing
+    return state.words, still_processing
 
 
 def insert_link(word):
-    global intLink
-    global page
-    global words
-    global pages
-    # the link may be split if it contains spaces so it may be sent in parts
+    # the link may be split if it contains spaces so it may be sent in parts,
+    # which are collected in a list to join them once the link is complete
     brackets = word.find('((')
     if brackets != -1:
         word = word.replace('((', '[[')
-        page = word[brackets:]
-        words.append(word[:brackets])
+        state.page = [word[brackets:]]
+        state.words.append(word[:brackets])
         if '))' in word:
             word = word.replace('))', ']]')
             last_pos = word.find(']]')
-            text = word[brackets + 2:last_pos]
             # again check the filenames to ensure case sensitivity is ok
-            for file in pages:
-                if file.encode("Latin-1").lower() \
-                        == text.lower():
-                    text = file
+            text = canonical_title(word[brackets + 2:last_pos])
             text = '[[' + text + word[last_pos:]
             if text[-1] != '\n':
-                words.append(text + ' ')
+                state.words.append(text + ' ')
             else:
-                words.append(text)
-            page = ''
-            intLink = False
+                state.words.append(text)
+            state.page = []
+            state.intLink = False
 
     elif '))' in word:
         word = word.replace('))', ']]')
-        page += ' ' + word
+        state.page.append(' ' + word)
+        page = ''.join(state.page)
         pipe = page.find('|')
         if pipe != -1:
             last_pos = pipe
-            text = page[2:pipe]
         else:
-            brackets = page.find(']]')
-            last_pos = brackets
-            text = page[2:brackets]
-        for file in pages:
-            if file.encode("latin-1").lower() == text.lower():
-                page = page[:2] + file + page[last_pos:]
+            last_pos = page.find(']]')
+        page = page[:2] + canonical_title(page[2:last_pos]) + page[last_pos:]
         if page[-1] != '\n':
-            words.append(page + ' ')
+            state.words.append(page + ' ')
         else:
-            words.append(page)
-        page = ''
-        intLink = False
+            state.words.append(page)
+        state.page = []
+        state.intLink = False
+    else:
+        state.page.append(' ' + word)
+
+
+def wrap_nowiki(elem):
+    """
+    Wrap a word in nowiki tags to stop MediaWiki from automatically creating
+    links, which can then be broken by formatting. Apostrophes stay outside
+    the tags to keep their meaning as formatting.
+    """
+    def close_nowiki(match):
+        if match.end() == len(elem):
+            return '</nowiki>' + match.group()
+        return '</nowiki>' + match.group() + '<nowiki>'
+
+    return '<nowiki>' + re.sub("'+", close_nowiki, elem) + '</nowiki>'
+
+
+def convert_external_link(line):
+    """
+    Convert the last external link `[url|text]` of a line to MediaWiki
+    syntax.
+
+    The link's delimiters are searched from the end of the line, which finds
+    the same link as matching `(.*)\\[(.*)\\|(.*)\\](.*)` without any
+    backtracking. The last escaped ampersand of the URL followed by a
+    semicolon is unescaped and the semicolon dropped.
+
+    :param str line: a line of the revision
+    :return: the line with the converted link, which always ends with a
+        newline
+    """
+    end = line.rfind(']')
+    pipe = line.rfind('|', 0, end) if end != -1 else -1
+    start = line.rfind('[', 0, pipe) if pipe != -1 else -1
+    if start == -1:
+        return line
+    url = line[start + 1:pipe]
+    semicolon = url.rfind(';')
+    ampersand = url.rfind('&amp;', 0, semicolon) if semicolon != -1 else -1
+    if ampersand != -1:
+        url = url[:ampersand] + '&' + url[ampersand + 5:semicolon] \
+              + url[semicolon + 1:]
+    rest = line[end + 1:]
+    if rest.endswith('\n'):
+        rest = rest[:-1]
+    return line[:start] + '[' + urlMap.rewrite(url) + ' ' \
+        + line[pipe + 1:end] + ']' + rest + '\n'
+
+
+# The directives of TikiWiki plugins converted line by line in this order,
+# which can be extended by --rules. A rule either replaces its literal
+# `open`, or the text from the first `open` to the last following `close`
+# by `replace`, which refers to the enclosed text as \1 or, split at the
+# last `separator` in between, as \1 and \2. Rules with a regular
+# expression `pattern` replace its matches in lines containing `open`.
+line_rules = [
+    # Convert external links to MediaWiki syntax
+    {'open': '|', 'function': convert_external_link},
+    # Convert 'CODE' samples to MediaWiki syntax
+    {'open': '{CODE(caption=&amp;gt;', 'close': ')}',
+     'replace': r'<!-- \1 --><source>'},
+    {'open': '{CODE(', 'close': ')}', 'replace': '<source>'},
+    {'open': '{CODE}', 'replace': '</source>'},
+    # Convert anchor
+    {'open': '{ANAME()}', 'close': '{ANAME}',
+     'replace': r'<span id=&quot;\1&quot;></span>'},
+    # Convert anchor links
+    {'open': '{ALINK(aname=',
+     'pattern': r'{ALINK\(aname=(?:")?([^"]*)(?:")?\)}(.*){ALINK}',
+     'replace': r'[[#\1|\2]]'},
+    # Convert formulas based on the MathJax macro.
+    {'open': '{HTML()}', 'replace': '<macro:mathjax>'},
+    {'open': '{HTML}', 'replace': '</macro:mathjax>'},
+]
+
+
+def compile_rules(rules):
+    """
+    Compile the line rules into one alternation of their literal openings,
+    which finds the rules to apply to a line in a single scan.
+
+    :param list[dict] rules: the rules in the order they are applied
+    """
+    global lineRules
+    global ruleTriggers
+    global ruleInitials
+    global impliedTriggers
+    lineRules = []
+    for rule in rules:
+        rule = dict(rule)
+        if 'pattern' in rule:
+            rule['pattern'] = re.compile(rule['pattern'])
+        lineRules.append(rule)
+    openings = sorted(set(rule['open'] for rule in rules), key=len,
+                      reverse=True)
+    # a lookahead finds the longest opening at every position, which
+    # implies all openings it contains
+    ruleTriggers = re.compile(
+        '(?=(' + '|'.join(re.escape(opening) for opening in openings) + '))')
+    ruleInitials = set(opening[0] for opening in openings)
+    impliedTriggers = dict(
+        (opening, set(other for other in openings if other in opening))
+        for opening in openings)
+
+
+def rule_triggers(line):
+    """
+    Return the openings of all rules found in a line.
+    """
+    found = set()
+    for match in ruleTriggers.finditer(line):
+        found.update(impliedTriggers[match.group(1)])
+    return found
+
+
+def expand_rule(template, groups):
+    """
+    Insert the enclosed text into the replacement of a rule.
+    """
+    return re.sub(r'\\([12])', lambda match: groups[int(match.group(1)) - 1],
+                  template)
+
+
+def apply_rule(rule, line):
+    """
+    Apply one rule to a line.
+
+    :return: the converted line
+    """
+    if 'function' in rule:
+        return rule['function'](line)
+    if 'pattern' in rule:
+        return rule['pattern'].sub(rule['replace'], line)
+    if 'close' not in rule:
+        return line.replace(rule['open'], rule['replace'])
+    # the same text as matched by the greedy `open(.*)close`
+    start = line.find(rule['open'])
+    if start == -1:
+        return line
+    inner = start + len(rule['open'])
+    end = line.rfind(rule['close'], inner)
+    if end == -1:
+        return line
+    groups = [line[inner:end]]
+    if 'separator' in rule:
+        separator = line.rfind(rule['separator'], inner, end)
+        if separator == -1:
+            return line
+        groups = [line[inner:separator],
+                  line[separator + len(rule['separator']):end]]
+    return line[:start] + expand_rule(rule['replace'], groups) \
+        + line[end + len(rule['close']):]
+
+
+def apply_rules(line):
+    """
+    Apply the rules, whose openings are found in a line, in their order.
+
+    The openings are searched again only after a rule changed the line.
+
+    :param str line: a line of the revision
+    :return: the converted line
+    """
+    found = rule_triggers(line)
+    for rule in lineRules:
+        if rule['open'] in found:
+            converted = apply_rule(rule, line)
+            if converted != line:
+                line = converted
+                found = rule_triggers(line)
+    return line
+
+
+compile_rules(line_rules)
+
+
+def convert_colours(elem, colour):
+    """
+    Convert the font colours `~~colour:text~~` of a word to HTML spans.
+
+    The colour of a span ends at the next colon, which is replaced by the
+    end of the span's start tag. The word is scanned once, remembering the
+    colons already replaced.
+
+    :param str elem: the word
+    :param bool colour: whether the word starts within a coloured text
+    :return: the converted word, whether it ends within a coloured text and
+        whether it ends within the colour of a span's start tag
+    """
+    converted = []
+    # the colons ending the colours of spans ahead of the scanned part
+    colons = collections.deque()
+    inColourTag = False
+    position = 0
+    while True:
+        check_deadline()
+        tildes = elem.find('~~', position)
+        end = len(elem) if tildes == -1 else tildes
+        while colons and colons[0] < end:
+            colon = colons.popleft()
+            converted.append(elem[position:colon] + "'>")
+            position = colon + 1
+        converted.append(elem[position:end])
+        if tildes == -1:
+            return ''.join(converted), colour, inColourTag
+        if colour:
+            # end span
+            colour = False
+            converted.append('</span>')
+        else:
+            # start span
+            colour = True
+            colon = elem.find(':', max(tildes, colons[-1] + 1 if colons
+                                       else tildes))
+            if colon != -1:
+                converted.append("<span style='color:")
+                colons.append(colon)
+            else:
+                converted.append('<span style="color:')
+                inColourTag = True
+        position = tildes + 2
+
+
+def convert_inline(mwiki):
+    """
+    Convert the inline TikiWiki syntax of a whole revision in one pass.
+
+    :param str mwiki: the revision after the conversion of HTML tags
+    :return: the converted revision
+    """
+    return ''.join(inline_chunks(mwiki.splitlines(True)))
+
+
+def inline_chunks(lines, size=0):
+    """
+    Convert the inline TikiWiki syntax of the lines of a revision.
+
+    The lines are tokenized into words separated by spaces. Headings,
+    centered text, font colours, attachments, internal links and bare URLs
+    are converted while tracking which TikiWiki environment the tokenizer is
+    currently in. Those environments might span several words or lines.
+    Lines which neither contain any of these constructs nor continue one of
+    the environments are emitted in one piece instead of word by word.
+
+    :param lines: the lines of the revision after the conversion of HTML
+        tags
+    :param int size: the number of characters read before the converted
+        text is handed on, or 0 to hand it on at the end
+    :return: a generator of the converted text in chunks
+    """
+    words = state.words = []
+    # Set variables to mark current enclosing TikiWiki environment
+    processing_attachment = False
+    state.intLink = False
+    box = False
+    colour = False
+    inColourTag = False
+    state.page = []
+    centre = False
+    bangs = 0
+    # the number of characters read since the words were handed on
+    pending = 0
+    # with --incremental the key of the line converted last, whose
+    # conversion is remembered with the environments it ends in unless it
+    # contains attachments, which are reported while converting them, and
+    # the index of its first word
+    key = None
+    start = 0
+    for line in lines:
+        check_deadline()
+        if key is not None:
+            state.lines[key] = (words[start:], (colour, inColourTag, centre,
+                                                tuple(state.page)))
+            key = None
+        if size:
+            pending += len(line)
+            if pending > size:
+                yield ''.join(words)
+                del words[:]
+                pending = len(line)
+        if options.incremental and not processing_attachment:
+            key = (line, state.intLink, colour, inColourTag, centre,
+                   tuple(state.page))
+            converted = state.lines.get(key) or state.previousLines.get(key)
+            if converted:
+                state.lines[key] = converted
+                words.extend(converted[0])
+                colour, inColourTag, centre, page = converted[1]
+                state.page = list(page)
+                key = None
+                continue
+            start = len(words)
+        # The directives of the rules are only searched for in lines which
+        # contain the first character of one of them, which most lines don't.
+        if any(char in line for char in ruleInitials):
+            line = apply_rules(line)
+
+        heading = line.startswith('!')
+        # Emit lines which need no conversion in one piece. Their words are
+        # separated by single spaces and every word not ending the line is
+        # followed by a space.
+        if not (heading or processing_attachment or state.intLink
+                or '::' in line or '~~' in line
+                or (inColourTag and ':' in line)
+                or 'http' in line or 'ftp://' in line
+                or any(tag in line for tag in attachment_identifiers)):
+            line = line.strip(' ')
+            if '  ' in line:
+                line = re.sub(' {2,}', ' ', line)
+            if line and line[-1] != '\n':
+                line += ' '
+            words.append(line)
+            continue
+
+        # if there are an odd no. of ::s don't convert to
+        # centered text
+        noCentre = line.count('::') % 2 != 0
+        spl = line.split(' ')
+        last = len(spl) - 1
+        for count, elem in enumerate(spl):
+            # handle headings
+            if heading:
+                if count == 0 and elem:
+                    # replace !s
+                    bangs = len(elem) - len(elem.lstrip('!'))
+                    elem = '=' * bangs + elem[bangs:]
+                    if bangs >= len(elem) and len(spl) == 1:
+                        bangs //= 2
+                if count == last:
+                    # add =s to end
+                    end = elem.find('\n')
+                    if end != -1:
+                        elem = elem[:end] + (bangs * '=') + elem[end:]
+                    else:
+                        elem = elem[:end] + (bangs * '=')
+            # handle centered text
+            if '::' in elem and not noCentre:
+                parts = elem.split('::')
+                centred = [parts[0]]
+                for part in parts[1:]:
+                    centred.append('</center>' if centre else '<center>')
+                    centred.append(part)
+                    centre = not centre
+                elem = ''.join(centred)
+            # handle font colours
+            if inColourTag:
+                colon = elem.find(':')
+                if colon != -1:
+                    elem = elem[:colon] + '">' + elem[colon + 1:]
+                    inColourTag = False
+            if '~~' in elem:
+                elem, colour, inColour = convert_colours(elem, colour)
+                inColourTag = inColourTag or inColour
+            if any(tag in elem for tag in attachment_identifiers):
+                processing_attachment = True
+            if processing_attachment:
+                key = None
+                words, processing_attachment = process_image(
+                    elem, attachment_identifiers)
+            elif state.intLink:
+                insert_link(elem)
+            else:
+                if ('http' in elem or 'ftp://' in elem) and '[' \
+                        not in elem and ']' not in elem and \
+                        '<pic>' not in elem and '<pre>' not in \
+                        elem and '</pre>' not in elem and not box:
+                    elem = wrap_nowiki(elem)
+                if elem != '':
+                    if '\n' in elem[-1]:
+                        words.append(elem)
+                    else:
+                        words.append(elem + ' ')
+
+    if key is not None:
+        state.lines[key] = (words[start:], (colour, inColourTag, centre,
+                                            tuple(state.page)))
+    yield ''.join(words)
+
+
+def contains_html(mwiki):
+    """
+    Check if the markup contains HTML tags, e.g. created by the WYSIWYG
+    editor.
+
+    :param str mwiki: the TikiWiki markup of a revision
+    :return: True if the HTMLChecker found any start tag
+    """
+    state.validate = False
+    validator = HTMLChecker()
+    # the markup is fed in blocks to stop at the first tag found
+    for block in html_blocks.split(mwiki):
+        validator.feed(block)
+        if state.validate:
+            break
+    return state.validate
+
+
+def feed_html(htmlConverter, html):
+    """
+    Feed HTML to the HTMLToMwiki parser.
+
+    With `--incremental` the HTML is split into blocks before tags and the
+    conversion of a block is reused if the same block was converted in the
+    same state in the current or the previous revision. Every block is
+    converted as it would be in the whole text, as the text between two tags
+    is never split.
+
+    :param HTMLToMwiki htmlConverter: the parser converting the revision
+    :param str html: the text to convert, which either ends before a tag or
+        the revision
+    """
+    if not options.incremental:
+        htmlConverter.feed(html)
+        return
+    wikitext = htmlConverter.wikitext
+    for block in html_blocks.split(html):
+        if not block:
+            continue
+        context = htmlConverter.context()
+        if context is None:
+            htmlConverter.feed(block)
+            continue
+        key = (block, context)
+        converted = state.blocks.get(key) or state.previousBlocks.get(key)
+        if converted:
+            check_deadline()
+            entries, end, uploads = converted
+            wikitext.extend(entries)
+            htmlConverter.restore(end)
+            state.uploads.extend(uploads)
+            state.blocks[key] = converted
+            continue
+        start = len(wikitext)
+        uploadStart = len(state.uploads)
+        htmlConverter.feed(block)
+        end = htmlConverter.context()
+        if end is not None:
+            state.blocks[key] = (wikitext[start:], end,
+                                 state.uploads[uploadStart:])
+
+
+# The replacements of the conversion in the order they are applied, which
+# are shared by the conversion of whole revisions and of revisions in chunks.
+
+# fixes pages that end up on a single line (these were probably created by
+# our WYSIWYG editor being used on windows and linux)
+plain_replacements = [
+    ('\t', '    '),
+    ('  ', ' &nbsp;'),
+    ('<', '&lt;'),
+    ('>', '&gt;'),
+    # as the page does not contain any html whitespace needs to be
+    # preserved, which makes sure newlines after headings are preserved as
+    # well
+    ('\r\n', '</br>'),
+]
+
+# double escape < and > entities so that &lt; is not unescaped to < which is
+# then treated as HTML tags
+entity_replacements = [
+    ('&amp;lt;', '&amp;amp;lt;'),
+    ('&amp;gt;', '&amp;amp;gt;'),
+    ('&lt;', '&amp;lt;'),
+    ('&gt;', '&amp;gt;'),
+    (u'\ufffd', '&nbsp;'),
+]
+
+# replace TikiWiki syntax that will be interpreted badly with TikiWiki syntax
+# the parser will understand empty formatting tags will be converted to many
+# "'"s which then confuses MediaWiki
+tiki_replacements = [
+    ('[[', '~np~[~/np~'),
+    # need to replace no wiki tags here in case any html/xml is inside them
+    # that we want to keep
+    ('~np~', '<nowiki>'),
+    ('~/np~', '</nowiki>'),
+    ('<em></em>', ''),
+    ('<em><em>', '<em>'),
+    ('</em></em>', '</em>'),
+    ('<strong></strong>', ''),
+    ('<strong><strong>', '<strong>'),
+    ('</strong></strong>', '</strong>'),
+    # this makes sure definitions keep their preceding newline
+    ('\n;', '</br>;'),
+    ('</br>', '\n'),
+    ('&lt;/br&gt;', '\n'),
+    ('\r', ' '),
+    ('\t', ' '),
+    # Mediawiki automatically creates a table of content
+    ('Table of content', ''),
+    ('{maketoc}', ''),
+]
+
+# make sure there are no single newlines - MediaWiki just ignores them.
+# Replace multiple lines with single and then single with double.
+newline_replacements = [
+    ('\n', '\n\n'),
+    # Add one space to bullet points.
+    ('\n*', '\n* '),
+    # replace multiple lines with single where they would break formatting -
+    # such as in a list
+    ('\n\n#', '\n#'),
+    ('\n\n*', '\n*'),
+    ('*<br/>', '*'),
+    ('#<br/>', '#'),
+]
+
+final_replacements = [
+    ('&lt;!--', '<!--'),
+    ('--&gt;', '-->'),
+    ("'''TOC'''", '__TOC__'),
+    ("'''NOTOC'''", '__NOTOC__'),
+]
+
+
+def convert_markup(mwiki):
+    """
+    Convert the TikiWiki markup of one revision to MediaWiki markup.
+
+    Revisions longer than `--chunk-size` are converted in chunks by
+    :func:`markup_chunks` instead.
+
+    :param str mwiki: the revision's TikiWiki markup, which might contain
+        HTML created by the WYSIWYG editor
+    :return: the MediaWiki markup escaped to be inserted into the XML
+    """
+    if 0 < options.chunksize < len(mwiki):
+        mark = memory_mark()
+        mwiki = ''.join(markup_chunks(mwiki, options.chunksize))
+        # the stages overlap, so both are recorded with their joint peak
+        memory_record('html', mark)
+        memory_record('inline', mark)
+        return mwiki
+
+    if not contains_html(mwiki):
+        for old, new in plain_replacements:
+            mwiki = mwiki.replace(old, new)
+
+    for old, new in entity_replacements:
+        mwiki = mwiki.replace(old, new)
+
+    # unescape XML entities
+    mwiki = unescape(mwiki, unescape_entitydefs)
+
+    for old, new in tiki_replacements:
+        mwiki = mwiki.replace(old, new)
+
+    # convert === underline syntax before the html converter as
+    # headings in MediaWiki use =s and h3 tags will become
+    # ===heading===
+    # if there is another === convert them both
+    underlined = []
+    next_elem = 0
+    while True:
+        check_deadline()
+        start = mwiki.find('===', next_elem)
+        end = mwiki.find('===', start + 3) if start != -1 else -1
+        if end == -1:
+            break
+        underlined.append(mwiki[next_elem:start] + '<u>'
+                          + mwiki[start + 3:end] + '</u>')
+        next_elem = end + 3
+    underlined.append(mwiki[next_elem:])
+    mwiki = ''.join(underlined)
+
+    # convert any HTML tags to MediaWiki syntax
+    mark = memory_mark()
+    htmlConverter = HTMLToMwiki()
+    feed_html(htmlConverter, mwiki)
+
+    mwiki = ''.join(htmlConverter.wikitext)
+    memory_record('html', mark)
+
+    # replace TikiWiki syntax with MediaWiki
+    mwiki = mwiki.replace('__', "'''")
+
+    # replace the inline TikiWiki syntax
+    mark = memory_mark()
+    mwiki = convert_inline(mwiki)
+    memory_record('inline', mark)
+    # get rid of pic placeholder tags
+    mwiki = mwiki.replace("<pic>", "")
+    mwiki = mwiki.replace("</pic>", "")
+
+    mwiki = re.sub('\n(?: \n)+', '\n', mwiki)
+    mwiki = re.sub('\n{2,}', '\n', mwiki)
+    for old, new in newline_replacements:
+        mwiki = mwiki.replace(old, new)
+    mwiki = mwiki.lstrip('\n')
+
+    lines = []
+    for line in mwiki.splitlines(True):
+        if line.startswith(':'):
+            line = '<nowiki>:</nowiki>' + line[1:]
+        lines.append(line)
+    mwiki = ''.join(lines)
+
+    mwiki = escape(mwiki, escape_entitydefs)
+
+    mwiki = mwiki.translate(control_characters)
+
+    mwiki = mwiki.replace('amp;lt;', 'lt;')
+    mwiki = mwiki.replace('amp;gt;', 'gt;')
+
+    # Replace double spaces by single space.
+    mwiki = re.sub(' {2,}', ' ', mwiki)
+    for old, new in final_replacements:
+        mwiki = mwiki.replace(old, new)
+
+    return mwiki
+
+
+def split_chunk(text, old):
+    """
+    Split a chunk of a text at `old` as :meth:`str.split` splits the whole
+    text, where the chunk is preceded by the end held back from the previous
+    chunk.
+
+    The last characters which might start a match continued in the next
+    chunk are held back. A match starting earlier is complete, so the
+    matches are found from left to right without overlaps as in the whole
+    text.
+
+    :return: the parts of the chunk and its end held back
+    """
+    parts = text.split(old)
+    keep = len(parts[-1]) - min(len(parts[-1]), len(old) - 1)
+    carry = parts[-1][keep:]
+    parts[-1] = parts[-1][:keep]
+    return parts, carry
+
+
+def split_chunks(chunks, old):
+    """
+    Split a text given in chunks at `old`.
+
+    :return: a generator of the lists of parts of consecutive pieces of the
+        text, where the last part of a list is continued by the first part
+        of the next one
+    """
+    carry = ''
+    for chunk in chunks:
+        parts, carry = split_chunk(carry + chunk, old)
+        yield parts
+    yield [carry]
+
+
+def replace_chunks(chunks, replacements):
+    """
+    Apply the replacements to a text given in chunks one after the other as
+    :meth:`str.replace` would apply them to the whole text.
+
+    :param chunks: the text in chunks
+    :param list[tuple] replacements: the strings to replace and their
+        replacements
+    :return: a generator of the replaced text in chunks
+    """
+    carries = [''] * len(replacements)
+    for chunk in chunks:
+        for index, (old, new) in enumerate(replacements):
+            parts, carries[index] = split_chunk(carries[index] + chunk, old)
+            chunk = new.join(parts)
+        yield chunk
+    # the end held back by each replacement is passed on to the next ones
+    chunk = ''
+    for carry, (old, new) in zip(carries, replacements):
+        chunk = (carry + chunk).replace(old, new)
+    yield chunk
+
+
+def sub_chunks(chunks, pattern, replacement, characters):
+    """
+    Replace the matches of a regular expression in a text given in chunks
+    as :func:`re.sub` would in the whole text.
+
+    The matches must consist of `characters` only, whose run at the end of a
+    chunk is held back as it might continue in the next chunk.
+    """
+    carry = ''
+    for chunk in chunks:
+        text = carry + chunk
+        end = len(text.rstrip(characters))
+        carry = text[end:]
+        yield re.sub(pattern, replacement, text[:end])
+    yield re.sub(pattern, replacement, carry)
+
+
+def underline_chunks(chunks, matches):
+    """
+    Convert the === underline syntax in a text given in chunks, where
+    consecutive pairs of the number of `matches` found before are converted
+    and a last unpaired === is kept.
+    """
+    count = 0
+    for parts in split_chunks(chunks, '==='):
+        check_deadline()
+        underlined = [parts[0]]
+        for part in parts[1:]:
+            count += 1
+            if count > matches - matches % 2:
+                underlined.append('===')
+            else:
+                underlined.append('<u>' if count % 2 else '</u>')
+            underlined.append(part)
+        yield ''.join(underlined)
+
+
+def html_chunks(chunks):
+    """
+    Convert the HTML tags of a text given in chunks to MediaWiki syntax.
+
+    The chunks are fed to the HTMLToMwiki parser up to the last `<` they
+    contain, so the text between two tags is always handled as a whole as
+    it would be in the whole text. The converted text is handed on after
+    each chunk except for the last entries checked by
+    :meth:`HTMLToMwiki.check_append`.
+    """
+    htmlConverter = HTMLToMwiki()
+    wikitext = htmlConverter.wikitext
+    pending = []
+    for chunk in chunks:
+        tag = chunk.rfind('<')
+        if tag == -1:
+            pending.append(chunk)
+            continue
+        pending.append(chunk[:tag])
+        feed_html(htmlConverter, ''.join(pending))
+        pending = [chunk[tag:]]
+        if len(wikitext) > 3:
+            yield ''.join(wikitext[:-3])
+            del wikitext[:-3]
+    feed_html(htmlConverter, ''.join(pending))
+    yield ''.join(wikitext)
+
+
+def split_lines(chunks):
+    """
+    Split a text given in chunks into its lines as
+    :meth:`str.splitlines` keeping the line ends does.
+    """
+    pending = []
+    for chunk in chunks:
+        # a carriage return and a newline end a line together
+        if pending and pending[-1].endswith('\r') and chunk.startswith('\n'):
+            pending.append('\n')
+            chunk = chunk[1:]
+        for line in chunk.splitlines(True):
+            if pending and pending[-1][-1] in line_terminators:
+                yield ''.join(pending)
+                pending = []
+            pending.append(line)
+    if pending:
+        yield ''.join(pending)
+
+
+def lstrip_chunks(chunks, characters):
+    """
+    Strip the leading `characters` from a text given in chunks.
+    """
+    chunks = iter(chunks)
+    for chunk in chunks:
+        chunk = chunk.lstrip(characters)
+        if chunk:
+            yield chunk
+            break
+    yield from chunks
+
+
+def line_colon_chunks(chunks):
+    """
+    Wrap colons starting a line of a text given in chunks in nowiki tags,
+    so they are not interpreted as indentation.
+    """
+    # the text starts with a line
+    previous = '\n'
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if chunk[0] == ':' and previous in line_terminators:
+            chunk = '<nowiki>:</nowiki>' + chunk[1:]
+        previous = chunk[-1]
+        yield re.sub('([' + line_terminators + ']):',
+                     r'\1<nowiki>:</nowiki>', chunk)
+
+
+def markup_chunks(mwiki, size):
+    """
+    Convert the TikiWiki markup of one revision to MediaWiki markup in
+    chunks, which gives the same result as :func:`convert_markup`.
+
+    The steps of the conversion are chained generators, which hand on their
+    text in chunks of about `size` characters, so only the text between two
+    HTML tags and the longest line are held as a whole. The markup is read
+    twice to count the === underline syntax first.
+
+    :param str mwiki: the revision's TikiWiki markup
+    :param int size: the number of characters per chunk
+    :return: a generator of the MediaWiki markup escaped to be inserted into
+        the XML in chunks
+    """
+    plain = not contains_html(mwiki)
+
+    def replaced():
+        chunks = (mwiki[start:start + size]
+                  for start in range(0, len(mwiki), size))
+        if plain:
+            chunks = replace_chunks(chunks, plain_replacements)
+        return replace_chunks(chunks, entity_replacements
+                              + unescape_replacements + tiki_replacements)
+
+    matches = sum(len(parts) - 1
+                  for parts in split_chunks(replaced(), '==='))
+    chunks = html_chunks(underline_chunks(replaced(), matches))
+    chunks = replace_chunks(chunks, [('__', "'''")])
+    chunks = inline_chunks(split_lines(chunks), size)
+    chunks = replace_chunks(chunks, [('<pic>', ''), ('</pic>', '')])
+    chunks = sub_chunks(chunks, '\n(?: \n)+', '\n', '\n ')
+    chunks = sub_chunks(chunks, '\n{2,}', '\n', '\n')
+    chunks = replace_chunks(chunks, newline_replacements)
+    chunks = line_colon_chunks(lstrip_chunks(chunks, '\n'))
+    chunks = replace_chunks(chunks, escape_replacements)
+    chunks = (chunk.translate(control_characters) for chunk in chunks)
+    chunks = replace_chunks(chunks, [('amp;lt;', 'lt;'), ('amp;gt;', 'gt;')])
+    chunks = sub_chunks(chunks, ' {2,}', ' ', ' ')
+    return replace_chunks(chunks, final_replacements)
+
+
+def raw_text(payload):
+    """
+    Insert the unconverted markup of a revision as raw text, which is
+    escaped to be inserted into the XML and wrapped in nowiki tags.
+
+    :param str payload: the revision's TikiWiki markup
+    :return: the escaped text
+    """
+    text = payload.replace('</nowiki', '&lt;/nowiki')
+    # characters not allowed in XML are replaced as in the conversion
+    text = re.sub('[\x00-\x08\x0b\x0c\x0e-\x1f]', '?', text)
+    return escape('<nowiki>' + text + '</nowiki>')
+
+
+def convert_revision(markup, payload):
+    """
+    Convert the markup of a revision within the time budget set by
+    `--time-budget`. If the budget is exceeded, the revision's raw payload
+    is inserted instead and the run continues.
+
+    :param str markup: the complete TikiWiki markup of the revision as
+        returned by :func:`revision_markup`
+    :param str payload: the revision's content as exported
+    :return: the converted or raw text and whether the budget was exceeded
+    """
+    if options.timebudget <= 0:
+        return convert_markup(markup), False
+    state.deadline = time.monotonic() + options.timebudget
+    try:
+        return convert_markup(markup), False
+    except TimeBudgetExceeded:
+        sys.stderr.write('Revision ' + str(state.partcount - 1)
+                         + ' of the page "' + state.title + '" with '
+                         + str(len(payload)) + ' characters exceeded the '
+                         'time budget of ' + str(options.timebudget)
+                         + ' s and is inserted as raw text\n')
+        return raw_text(payload), True
+    finally:
+        state.deadline = None
+
+
+def revision_markup(description, payload):
+    """
+    Prepend the page description and the table of contents to the content of
+    a revision as it was displayed in TikiWiki.
+
+    :param str description: the quoted page description or None
+    :param str payload: the revision's TikiWiki markup
+    :return: the complete TikiWiki markup of the revision
+    """
+    mwiki = ''
+    # we add the TikiWiki description to the page in bold and italic (much
+    # as it was in TikiWiki ) for them to function properly we need to
+    # ensure that these strings are followed by a new line the </br> is used
+    # as a placeholder and is converted to \n later
+    if description not in (None, ''):
+        mwiki += "'''''" + unquote(description) + "'''''</br>"
+    # then add the table of contents (or specify none)
+    if options.notoc:
+        mwiki = mwiki + "__NOTOC__</br>"
     else:
-        page += ' ' + word
+        mwiki += "__TOC__</br>"
+    return mwiki + payload
+
+
+def page_revisions(mimefile):
+    """
+    Read the revisions of one page exported by TikiWiki without converting
+    them.
+
+    Consecutive revisions with identical content are dropped or collapsed
+    into one revision according to `--identical-revisions`. They are
+    detected by the hash of their content before the conversion.
+
+    :param email.message.Message mimefile: the parsed MIME export of the page
+    :return: the page as a dict with its `title`, its `revisions` as dicts
+        with `timestamp`, `author`, the number of their MIME `part`, the
+        page `description` and their `payload` in the order of the export,
+        the number of `versions` found and the number of `skipped`
+        identical versions
+    """
+    partcount = 0
+    title = ''
+    versions = 0
+    skipped = 0
+    revisions = []
+    # the hash of the previous revision's content
+    previous = None
+
+    if not mimefile.is_multipart():
+        partcount = 1
+    for part in mimefile.walk():
+        if partcount == 1:
+            title = unquote(part.get_param('pagename'))
+        partcount += 1
+        if part.get_params() is not None and \
+                ('application/x-tikiwiki', '') in part.get_params():
+            versions += 1
+            if part.get_param('lastmodified') is None:
+                break
+            revision = {
+                'timestamp': time.strftime(
+                    '%Y-%m-%dT%H:%M:%SZ', time.gmtime(ast.literal_eval(
+                        part.get_param('lastmodified')))),
+                'author': part.get_param('author'),
+                'part': partcount,
+                'description': part.get_param('description'),
+                'payload': part.get_payload(),
+            }
+            if options.identical != 'keep':
+                # the hash of the complete markup without concatenating it
+                digest = hashlib.sha1(revision_markup(
+                    revision['description'], '').encode('utf-8'))
+                digest.update(revision['payload'].encode('utf-8'))
+                digest = digest.digest()
+                if digest == previous:
+                    skipped += 1
+                    kept = revisions[-1]
+                    # dropping keeps the oldest and collapsing the newest
+                    # save of identical revisions
+                    if options.identical == 'drop':
+                        replace = revision['timestamp'] < kept['timestamp']
+                    else:
+                        replace = revision['timestamp'] > kept['timestamp']
+                        kept['collapsed'] = kept.get('collapsed', 1) + 1
+                    if replace:
+                        kept['timestamp'] = revision['timestamp']
+                        kept['author'] = revision['author']
+                    continue
+                previous = digest
+            revisions.append(revision)
+        else:
+            if partcount != 1:
+                if not sys.stdout:
+                    sys.stdout.write(str(
+                        part.get_param('pagename')) + ' version ' + str(
+                        part.get_param('version')) + ' wasn\'t counted')
+
+    return {'title': title, 'revisions': revisions, 'versions': versions,
+            'skipped': skipped}
+
+
+def rotate_caches():
+    """
+    Start the conversion of a new revision with `--incremental`, keeping
+    only the conversions of the previous revision for reuse.
+    """
+    state.previousBlocks, state.blocks = state.blocks, {}
+    state.previousLines, state.lines = state.lines, {}
+
+
+def convert_part(title, partcount, description, payload):
+    """
+    Convert one revision of a page, which is independent of the page's
+    other revisions.
+
+    :param str title: the title of the page referenced in messages
+    :param int partcount: the number of the revision's MIME part
+    :param str description: the quoted page description or None
+    :param str payload: the revision's TikiWiki markup
+    :return: a dict with the converted `text`, whether the revision
+        `exceeded` the time budget, the `uploads` linked and the IDs of
+        `missing_attachments`
+    """
+    state.title = title
+    state.partcount = partcount
+    state.uploads = []
+    state.missingAttachments = []
+    rotate_caches()
+    text, exceeded = convert_revision(revision_markup(description, payload),
+                                      payload)
+    return {'text': text, 'exceeded': exceeded, 'uploads': state.uploads,
+            'missing_attachments': state.missingAttachments}
+
+
+def assemble_page(page, results):
+    """
+    Combine the converted revisions of a page.
+
+    :param dict page: the page as returned by :func:`page_revisions`
+    :param list[dict] results: the revisions as returned by
+        :func:`convert_part` in the order of the page's revisions
+    :return: the page as a dict with its `title`, its `revisions` as dicts
+        with `timestamp`, `author` and converted `text` in the order of the
+        export, the number of `versions` found, the number of `skipped`
+        identical versions, the `uploads` linked, the IDs of
+        `missing_attachments` and the revisions inserted unconverted for
+        being `over_budget`
+    """
+    revisions = []
+    uploads = []
+    missingAttachments = []
+    overbudget = []
+    for revision, result in zip(page['revisions'], results):
+        converted = {'timestamp': revision['timestamp'],
+                     'author': revision['author'], 'text': result['text']}
+        if 'collapsed' in revision:
+            converted['collapsed'] = revision['collapsed']
+        revisions.append(converted)
+        uploads.extend(result['uploads'])
+        for file_id in result['missing_attachments']:
+            if file_id not in missingAttachments:
+                missingAttachments.append(file_id)
+        if result['exceeded']:
+            overbudget.append({'title': page['title'],
+                               'revision': revision['part'] - 1,
+                               'characters': len(revision['payload'])})
+    return {'title': page['title'], 'revisions': revisions,
+            'versions': page['versions'], 'skipped': page['skipped'],
+            'uploads': uploads, 'missing_attachments': missingAttachments,
+            'over_budget': overbudget}
+
+
+def convert_page(mimefile):
+    """
+    Convert all revisions of one page exported by TikiWiki.
+
+    :param email.message.Message mimefile: the parsed MIME export of the page
+    :return: the page as returned by :func:`assemble_page`
+    """
+    page = page_revisions(mimefile)
+    return assemble_page(page, [
+        convert_part(page['title'], revision['part'],
+                     revision['description'], revision['payload'])
+        for revision in page['revisions']])
+
+
+def format_page(converted):
+    """
+    Format a converted page as MediaWiki XML.
+
+    The revisions are written in reverse order to get the newest entry last.
+    That maybe unimportant to MediaWiki, but importing the result to XWiki as
+    MediaWiki-Export requires this sorting.
+
+    :param dict converted: the page as returned by :func:`convert_page`
+    :return: the page's `<page>` element
+    """
+    xml = ['<page>\n', '<title>' + converted['title'] + '</title>\n']
+    revid = len(converted['revisions'])
+    for revision in reversed(converted['revisions']):
+        xml.append('<revision>\n<id>' + str(revid) + '</id>\n')
+        if revid > 1:
+            xml.append('<parentid>' + str(revid - 1) + '</parentid>\n')
+        xml.append('<timestamp>' + revision['timestamp'] + '</timestamp>\n')
+        xml.append('<contributor><username>' + revision['author']
+                   + '</username></contributor>\n')
+        if 'collapsed' in revision:
+            xml.append('<comment>' + str(revision['collapsed'])
+                       + ' identical revisions collapsed</comment>\n')
+        xml.append('<text xml:space="preserve">\n' + revision['text']
+                   + '</text>\n</revision>\n')
+        revid -= 1
+    xml.append('</page>\n')
+    return ''.join(xml)
+
+
+def xwiki_reference(*names):
+    """
+    Join the names of a space and a page to an XWiki document reference,
+    escaping the separators in the names.
+    """
+    return '.'.join(re.sub(r'([\\.:])', r'\\\1', name) for name in names)
+
+
+def xwiki_date(timestamp):
+    """
+    Convert the timestamp of a revision to milliseconds since the epoch as
+    used for dates in XWiki documents.
+    """
+    return str(int(datetime.datetime.strptime(
+        timestamp, '%Y-%m-%dT%H:%M:%SZ').replace(
+        tzinfo=datetime.timezone.utc).timestamp()) * 1000)
+
+
+def format_xwikidoc(space, title, revision, version, first):
+    """
+    Format one revision of a page as XWiki document XML.
+
+    :param str space: the XWiki space of the page
+    :param str title: the page's title, which is its name in the space
+    :param dict revision: the revision as in the page returned by
+        :func:`convert_page`
+    :param int version: the number of the revision counting from 1
+    :param dict first: the first revision, which created the page
+    :return: the document's XML with its content in MediaWiki syntax
+    """
+    date = xwiki_date(revision['timestamp'])
+    author = escape('XWiki.' + revision['author'])
+    comment = ''
+    if 'collapsed' in revision:
+        comment = str(revision['collapsed']) + ' identical revisions collapsed'
+    return ''.join([
+        '<?xml version="1.1" encoding="UTF-8"?>\n',
+        '<xwikidoc version="1.3" reference="'
+        + escape(xwiki_reference(space, title), {'"': '&quot;'})
+        + '" locale="">\n',
+        '<web>' + escape(space) + '</web>\n',
+        '<name>' + escape(title) + '</name>\n',
+        '<language/>\n<defaultLanguage/>\n<translation>0</translation>\n',
+        '<creator>' + escape('XWiki.' + first['author']) + '</creator>\n',
+        '<creationDate>' + xwiki_date(first['timestamp'])
+        + '</creationDate>\n',
+        '<parent/>\n',
+        '<author>' + author + '</author>\n',
+        '<contentAuthor>' + author + '</contentAuthor>\n',
+        '<date>' + date + '</date>\n',
+        '<contentUpdateDate>' + date + '</contentUpdateDate>\n',
+        '<version>1.' + str(version) + '</version>\n',
+        '<title>' + escape(title) + '</title>\n',
+        '<comment>' + comment + '</comment>\n',
+        '<minorEdit>false</minorEdit>\n',
+        '<syntaxId>mediawiki/1.6</syntaxId>\n',
+        '<hidden>false</hidden>\n',
+        # the converted text is escaped for XML already
+        '<content>' + revision['text'] + '</content>\n',
+        '</xwikidoc>\n'])
+
+
+def rcs_delta(newer, older):
+    """
+    Compute the RCS delta restoring the lines `older` from the lines
+    `newer`, as stored for all but the newest revision in the history of
+    an XWiki document.
+    """
+    delta = []
+    matcher = difflib.SequenceMatcher(None, newer, older, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ('replace', 'delete'):
+            delta.append('d{} {}\n'.format(i1 + 1, i2 - i1))
+        if tag in ('replace', 'insert'):
+            delta.append('a{} {}\n'.format(i2, j2 - j1))
+            delta.extend(older[j1:j2])
+    return ''.join(delta)
+
+
+def format_xwiki_page(converted, space):
+    """
+    Format a converted page as XWiki document XML with its revisions as
+    history, to be stored in a XAR package.
+
+    The newest revision is the document and all revisions are stored in
+    the RCS archive of its `<versions>`, the newest with its complete XML
+    and the older ones as deltas to their successors.
+
+    :param dict converted: the page as returned by :func:`convert_page`
+    :param str space: the XWiki space of the page
+    :return: the reference of the document and its XML
+    """
+    # the revisions with the newest last as in the MediaWiki XML
+    revisions = list(reversed(converted['revisions']))
+    if not revisions:
+        return None
+    documents = [format_xwikidoc(space, converted['title'], revision,
+                                 version, revisions[0])
+                 for version, revision in enumerate(revisions, 1)]
+    head = len(revisions)
+
+    def rcs_string(text):
+        return '@' + text.replace('@', '@@') + '@'
+
+    rcs = ['head\t1.{};\naccess;\nsymbols;\nlocks; strict;\n'
+           'comment\t@# @;\n\n'.format(head)]
+    for version in range(head, 0, -1):
+        revision = revisions[version - 1]
+        rcs.append('\n1.{}\ndate\t{};\tauthor\t{};\tstate\tExp;\n'
+                   'branches;\nnext\t{};\n'.format(
+                       version, time.strftime(
+                           '%Y.%m.%d.%H.%M.%S', time.strptime(
+                               revision['timestamp'], '%Y-%m-%dT%H:%M:%SZ')),
+                       'XWiki.' + revision['author'],
+                       '1.' + str(version - 1) if version > 1 else ''))
+    rcs.append('\n\ndesc\n@@\n')
+    for version in range(head, 0, -1):
+        if version == head:
+            text = documents[version - 1]
+        else:
+            text = rcs_delta(documents[version].splitlines(True),
+                             documents[version - 1].splitlines(True))
+        rcs.append('\n\n1.{}\nlog\n@@\ntext\n{}\n'.format(
+            version, rcs_string(text)))
+    document = documents[-1]
+    closing = document.rindex('</xwikidoc>')
+    return (xwiki_reference(space, converted['title']),
+            document[:closing] + '<versions>' + escape(''.join(rcs))
+            + '</versions>\n' + document[closing:])
+
+
+class XarPackage:
+    """
+    Write XWiki documents into a XAR package, a zip file of the documents'
+    XML with a `package.xml` listing them.
+
+    Every document is compressed into the package as soon as it is written,
+    so the package is streamed and never held in memory.
+    """
+
+    def __init__(self, fileobj):
+        """
+        :param fileobj: the binary file to write the package to, which
+            doesn't need to be seekable
+        """
+        self.fileobj = fileobj
+        self.package = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED)
+        self.references = []
+
+    def write(self, document):
+        """
+        Add a document as returned by :func:`format_xwiki_page`.
+        """
+        if document is None:
+            return
+        reference, xml = document
+        self.package.writestr(
+            'documents/' + quote(reference, safe='') + '.xml',
+            xml.encode('utf-8'))
+        self.references.append(reference)
+
+    def close(self):
+        """
+        Add the `package.xml` and finish the package.
+        """
+        files = ''.join('<file defaultAction="0" language="">'
+                        + escape(reference) + '</file>\n'
+                        for reference in self.references)
+        self.package.writestr('package.xml', (
+            '<?xml version="1.1" encoding="UTF-8"?>\n'
+            '<package>\n<infos>\n<name>TikiWiki</name>\n'
+            '<description>Pages converted from TikiWiki</description>\n'
+            '<licence/>\n<author>XWiki.Admin</author>\n'
+            '<version/>\n<backupPack>true</backupPack>\n'
+            '<preserveVersion>true</preserveVersion>\n</infos>\n'
+            '<files>\n' + files + '</files>\n</package>\n').encode('utf-8'))
+        self.package.close()
+        if self.fileobj is not sys.__stdout__.buffer:
+            self.fileobj.close()
+
+
+# the escapes of the default format of MySQL's LOAD DATA
+tsv_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n',
+                             '\r': '\\r', '\0': '\\0'})
+
+
+def tsv_row(*fields):
+    """
+    Format a row of a bulk-load table with tab separated fields.
+    """
+    return '\t'.join(str(field).translate(tsv_escapes)
+                     for field in fields) + '\n'
+
+
+def base36_sha1(text):
+    """
+    Return the SHA-1 of a revision's text in base 36 padded to 31 digits as
+    stored by MediaWiki.
+    """
+    number = int(hashlib.sha1(text.encode('utf-8')).hexdigest(), 16)
+    digits = []
+    while number:
+        number, digit = divmod(number, 36)
+        digits.append('0123456789abcdefghijklmnopqrstuvwxyz'[digit])
+    return ''.join(reversed(digits)).rjust(31, '0')
+
+
+class TableWriter:
+    """
+    Write the pages as rows of the MediaWiki tables `page`, `revision` and
+    `text` into the tab separated files `page.tsv`, `revision.tsv` and
+    `text.tsv` of a directory, to be loaded by bulk inserts like
+    `LOAD DATA INFILE` instead of importing the XML.
+
+    The IDs of pages, revisions and texts are counted from 1 in the order
+    the pages are written and the revisions of each page are numbered with
+    the newest last as in the MediaWiki XML. The columns are those of
+    `page_columns`, `revision_columns` and `text_columns`.
+    """
+
+    page_columns = ('page_id', 'page_namespace', 'page_title',
+                    'page_is_redirect', 'page_is_new', 'page_random',
+                    'page_touched', 'page_latest', 'page_len')
+    revision_columns = ('rev_id', 'rev_page', 'rev_text_id', 'rev_comment',
+                        'rev_user', 'rev_user_text', 'rev_timestamp',
+                        'rev_minor_edit', 'rev_deleted', 'rev_len',
+                        'rev_parent_id', 'rev_sha1')
+    text_columns = ('old_id', 'old_text', 'old_flags')
+
+    def __init__(self, directory):
+        """
+        :param str directory: the directory to write the tables to, which is
+            created if it doesn't exist
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.tables = [open(os.path.join(directory, name + '.tsv'), 'w',
+                            encoding='utf-8', newline='')
+                       for name in ('page', 'revision', 'text')]
+        self.pageID = 0
+        self.revisionID = 0
+
+    def format(self, converted):
+        """
+        Format a converted page as rows of the tables.
+
+        This assigns the IDs and has to be called in the order the pages are
+        written.
+
+        :param dict converted: the page as returned by :func:`convert_page`
+        :return: the rows of the page, its revisions and their texts
+        """
+        revisions = list(reversed(converted['revisions']))
+        if not revisions:
+            return None
+        self.pageID += 1
+        revisionRows = []
+        textRows = []
+        parent = 0
+        for revision in revisions:
+            self.revisionID += 1
+            # the text as it is read from the XML by importDump.php
+            text = unescape(revision['text'], {'&#124;': '|'})
+            length = len(text.encode('utf-8'))
+            timestamp = re.sub('[-T:Z]', '', revision['timestamp'])
+            comment = ''
+            if 'collapsed' in revision:
+                comment = str(revision['collapsed']) \
+                    + ' identical revisions collapsed'
+            revisionRows.append(tsv_row(
+                self.revisionID, self.pageID, self.revisionID, comment, 0,
+                revision['author'], timestamp, 0, 0, length, parent,
+                base36_sha1(text)))
+            textRows.append(tsv_row(self.revisionID, text, 'utf-8'))
+            parent = self.revisionID
+        # MediaWiki stores titles with underscores and capitalized as done
+        # by importDump.php
+        title = converted['title'].replace(' ', '_')
+        title = title[:1].upper() + title[1:]
+        # the value for Special:Random is derived from the title to get the
+        # same tables in every run
+        randomValue = zlib.crc32(title.encode('utf-8')) / 2 ** 32
+        pageRow = tsv_row(self.pageID, 0, title, 0, int(len(revisions) == 1),
+                          '{:.12f}'.format(randomValue), timestamp,
+                          self.revisionID, length)
+        return pageRow, ''.join(revisionRows), ''.join(textRows)
+
+    def write(self, rows):
+        """
+        Write the rows of a page as returned by :meth:`format`.
+        """
+        if rows is None:
+            return
+        for table, row in zip(self.tables, rows):
+            table.write(row)
+
+    def close(self):
+        for table in self.tables:
+            table.close()
+
+
+def write_atomic(path, data, mode=0o644):
+    """
+    Write a file by renaming a temporary file written next to it, so the
+    file is never seen partially written. A file which already has the
+    content is left untouched.
+
+    :param str path: the file to write, whose directory is created if it
+        doesn't exist
+    :param bytes data: the content of the file
+    :param int mode: the permissions of the file if it doesn't exist yet,
+        otherwise it keeps its permissions
+    """
+    try:
+        with open(path, 'rb') as existing:
+            if existing.read() == data:
+                return
+            mode = os.fstat(existing.fileno()).st_mode & 0o7777
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.',
+                                             suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(data)
+        # the temporary file is only readable by its owner
+        os.chmod(temporary, mode)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+class PageDirectory:
+    """
+    Write every page as a MediaWiki XML document of its own into a
+    directory, with an index of the pages in the order they are written.
+
+    The documents are named by the MD5 of the page title in subdirectories
+    named by its first hex digits like MediaWiki's hashed upload directory,
+    e.g. `d/d4/d4b1...xml`. They are written atomically by a pool of
+    threads, and documents which didn't change are not rewritten, so only
+    changed pages have to be synced and imported. The index is a tab
+    separated file with the title, the path and the SHA-1 of each document.
+    """
+
+    def __init__(self, directory, header, index='index.tsv', writers=1):
+        """
+        :param str directory: the directory to write the pages to, which is
+            created if it doesn't exist
+        :param str header: the `<siteinfo>` element written into every
+            document
+        :param str index: the name of the index file in the directory
+        :param int writers: the number of threads writing the documents
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.header = header
+        # the permissions of new files as created by open(), which are read
+        # by setting the umask before the writer threads are started
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0o666 & ~umask
+        self.index = index
+        self.entries = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(writers)
+        # limits the documents waiting to be written
+        self.pending = threading.BoundedSemaphore(options.queuesize)
+        self.errors = []
+
+    @staticmethod
+    def path(title):
+        """
+        Return the path of a page's document relative to the directory.
+        """
+        digest = hashlib.md5(title.encode('utf-8')).hexdigest()
+        return '/'.join((digest[0], digest[:2], digest + '.xml'))
+
+    def write(self, page):
+        """
+        Write a page given as its title and its `<page>` element.
+        """
+        if self.errors:
+            raise self.errors[0]
+        title, xml = page
+        document = ('<mediawiki xml:lang="en">\n' + self.header + xml
+                    + '</mediawiki>\n').encode('utf-8')
+        path = self.path(title)
+        self.entries.append(tsv_row(title, path,
+                                    hashlib.sha1(document).hexdigest()))
+        self.pending.acquire()
+        future = self.executor.submit(
+            write_atomic, os.path.join(self.directory, path), document,
+            self.mode)
+        future.add_done_callback(self.written)
+
+    def written(self, future):
+        self.pending.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def close(self):
+        """
+        Wait for the documents to be written and write the index.
+        """
+        self.executor.shutdown()
+        if self.errors:
+            raise self.errors[0]
+        write_atomic(os.path.join(self.directory, self.index),
+                     ''.join(self.entries).encode('utf-8'), self.mode)
+
+
+def well_formedness_error(xml):
+    """
+    Check that the XML of a page is well-formed.
+
+    The page is parsed as a document of its own without a document type
+    declaration, so no entities can be declared and expanded.
+
+    :param str xml: the XML of a page as formatted for the output
+    :return: None if the XML is well-formed, otherwise the ID of the
+        revision containing the error or None if it isn't within a revision
+        and the error message
+    """
+    try:
+        expat.ParserCreate().Parse(xml, True)
+    except expat.ExpatError as error:
+        start = 0
+        for _ in range(error.lineno - 1):
+            start = xml.find('\n', start) + 1
+        end = xml.find('\n', start)
+        revision = xml.rfind('<revision>\n<id>', 0,
+                             end if end != -1 else len(xml))
+        if revision == -1:
+            return None, str(error)
+        revision += len('<revision>\n<id>')
+        return xml[revision:xml.find('<', revision)], str(error)
+    return None
+
+
+class XmlValidator:
+    """
+    Check the well-formedness of the XML written for each page in a
+    background thread as set by `--validate-xml`, which reports the pages
+    that aren't well-formed to stderr as soon as they are written.
+    """
+
+    def __init__(self, size):
+        """
+        :param int size: the number of pages buffered for the validator
+        """
+        self.pages = queue.Queue(size)
+        # the pages which aren't well-formed by their title, the ID of the
+        # broken revision and the error message
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def check(self, title, xml):
+        """
+        Pass the XML of a page to the validator.
+
+        :param str title: the page's title or None for the header
+        :param str xml: the XML of the page as written
+        """
+        self.pages.put((title, xml))
+
+    def close(self):
+        """
+        Wait for the validator to check all pages.
+
+        :return: the pages which aren't well-formed
+        """
+        self.pages.put(None)
+        self.thread.join()
+        return self.errors
+
+    def run(self):
+        while True:
+            page = self.pages.get()
+            if page is None:
+                break
+            title, xml = page
+            error = well_formedness_error(xml)
+            if error is None:
+                continue
+            revision, message = error
+            if title is None:
+                where = 'the header'
+            elif revision is None:
+                where = 'the page "' + title + '"'
+            else:
+                where = 'revision ' + revision + ' of the page "' + title \
+                        + '"'
+            sys.stderr.write('The XML of ' + where + ' is not well-formed: '
+                             + message + '\n')
+            self.errors.append({'title': title, 'revision': revision,
+                                'error': message})
+
+
+class ProgressReporter:
+    """
+    Report the conversion progress to stderr at a throttled rate.
+
+    The number of pages and bytes to convert are known up front when the
+    archive is read from a file. When reading from stdin both totals are
+    unknown and neither percentage nor ETA are reported.
+
+    :param int total_pages: the number of pages to convert or 0 if unknown
+    :param int total_bytes: the size of all pages to convert or 0 if unknown
+    :param float interval: the minimum number of seconds between two reports
+    """
+
+    def __init__(self, total_pages=0, total_bytes=0, interval=1.0):
+        self.total_pages = total_pages
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.pages = 0
+        self.revisions = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last_report = 0.0
+
+    def update(self, pages=0, revisions=0, size=0):
+        self.pages += pages
+        self.revisions += revisions
+        self.bytes += size
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.report(now)
+
+    def report(self, now=None):
+        if now is None:
+            now = time.time()
+        self.last_report = now
+        elapsed = max(now - self.start, 1e-9)
+        if self.total_pages:
+            done = '{}/{} pages ({:.1f}%)'.format(
+                self.pages, self.total_pages,
+                100.0 * self.pages / self.total_pages)
+        else:
+            done = '{} pages'.format(self.pages)
+        line = '{}, {:.1f} revisions/s, {:.2f} MB/s'.format(
+            done, self.revisions / elapsed, self.bytes / elapsed / 1e6)
+        # Prefer the processed bytes to estimate the remaining time because
+        # page sizes vary a lot, and fall back to the number of pages.
+        if self.total_bytes and self.bytes:
+            remaining = elapsed * (self.total_bytes - self.bytes) / self.bytes
+            line += ', ETA ' + str(datetime.timedelta(seconds=int(remaining)))
+        elif self.total_pages and self.pages:
+            remaining = elapsed * (self.total_pages - self.pages) / self.pages
+            line += ', ETA ' + str(datetime.timedelta(seconds=int(remaining)))
+        sys.stderr.write(line + '\n')
 
 
 parser = OptionParser()
@@ -510,6 +2446,18 @@ parser.add_option("-p", "--privatepages", action="store", type="string",
 parser.add_option("-o", "--outputfile", action="store", type="string",
                   dest="outputfile", default='',
                   help="the name of the output wiki XML file(s)")
+parser.add_option("--format", action="store", type="choice",
+                  dest="outputformat", default='mediawiki',
+                  choices=['mediawiki', 'xar', 'tables', 'pages'],
+                  help="write MediaWiki XML, an XWiki XAR package with "
+                       "the pages' history or the directory given by -o "
+                       "with the MediaWiki tables page, revision and text "
+                       "as tab separated files for bulk loading or with "
+                       "a MediaWiki XML file per page (mediawiki, xar, "
+                       "tables or pages)")
+parser.add_option("--xar-space", action="store", type="string",
+                  dest="xarspace", default='Main',
+                  help="the XWiki space of the pages in a XAR package")
 parser.add_option("-k", "--imagexml", action="store", type="string",
                   dest="imagexml", default='',
                   help="an XML file containing metadata for the images in the "
@@ -517,508 +2465,1284 @@ parser.add_option("-k", "--imagexml", action="store", type="string",
 parser.add_option("-v", "--verbose", action="store_true", dest="verbose_mode",
                   default=False,
                   help="enable reporting to stdout about attachment conversion")
+parser.add_option("--progress", action="store_true", dest="progress",
+                  default=False,
+                  help="report pages done, revisions/s, MB/s and ETA to "
+                       "stderr")
+parser.add_option("--summary-json", action="store", type="string",
+                  dest="summaryjson", default='',
+                  help="write a machine-readable summary of the run to this "
+                       "JSON file")
+parser.add_option("--validate-xml", action="store_true",
+                  dest="validatexml", default=False,
+                  help="check that the XML of every page is well-formed "
+                       "while it is written and exit with an error if not")
+parser.add_option("--include", action="append", type="string",
+                  dest="include",
+                  help="only convert pages whose names match this glob or "
+                       "regular expression prefixed with 're:' (repeatable)")
+parser.add_option("--exclude", action="append", type="string",
+                  dest="exclude",
+                  help="don't convert pages whose names match this glob or "
+                       "regular expression prefixed with 're:' (repeatable)")
+parser.add_option("--pages-from", action="store", type="string",
+                  dest="pagesfrom", default='',
+                  help="only convert the pages listed in this file, one "
+                       "title per line")
+parser.add_option("--shard", action="store", type="string", dest="shard",
+                  default='',
+                  help="convert only the I-th of N shards of the pages given "
+                       "as I/N, while links are resolved against all pages")
+parser.add_option("--shard-by", action="store", type="choice",
+                  dest="shardby", default='hash', choices=['hash', 'size'],
+                  help="partition the pages into shards by the hash of "
+                       "their names or balanced by their size (hash or size)")
+parser.add_option("--trace-memory", action="store_true", dest="tracememory",
+                  default=False,
+                  help="trace the peak memory allocated per page and stage "
+                       "of the conversion and report the largest peaks")
+parser.add_option("--analyze", action="store_true", dest="analyze",
+                  default=False,
+                  help="report the size and contents of the archive instead "
+                       "of converting it")
+parser.add_option("--sample", action="store", type="int", dest="sample",
+                  default=0,
+                  help="convert this many random pages when analyzing to "
+                       "estimate the runtime of the conversion")
+parser.add_option("--rules", action="store", type="string", dest="rules",
+                  default='',
+                  help="a JSON file of rules converting additional TikiWiki "
+                       "plugins line by line")
+parser.add_option("--url-map", action="store", type="string",
+                  dest="urlmap", default='',
+                  help="a CSV or JSON file of exact and prefix rules "
+                       "rewriting the URLs of links")
+parser.add_option("--catalog", action="store", type="string",
+                  dest="catalog", default='',
+                  help="an SQLite file cataloging the pages and attachments "
+                       "of all conversions to resolve links and images "
+                       "across archives")
+parser.add_option("--time-budget", action="store", type="float",
+                  dest="timebudget", default=0,
+                  help="the maximum number of seconds to convert a single "
+                       "revision, which is inserted unconverted otherwise")
+parser.add_option("--identical-revisions", action="store", type="choice",
+                  dest="identical", default='keep',
+                  choices=['keep', 'drop', 'collapse'],
+                  help="keep consecutive revisions with identical content, "
+                       "drop all but the oldest or collapse them into the "
+                       "newest one (keep, drop or collapse)")
+parser.add_option("--chunk-size", action="store", type="int",
+                  dest="chunksize", default=0,
+                  help="convert revisions longer than this many characters "
+                       "in chunks of this size to limit the memory used")
+parser.add_option("--incremental", action="store_true",
+                  dest="incremental", default=False,
+                  help="reuse the conversion of HTML blocks and lines "
+                       "unchanged since the previous revision of a page")
+parser.add_option("--workers", action="store", type="int", dest="workers",
+                  default=0,
+                  help="convert pages in this many processes while reading "
+                       "the archive and writing the output in threads")
+parser.add_option("--threads", action="store", type="int", dest="threads",
+                  default=0,
+                  help="convert pages in this many threads instead of "
+                       "processes on a free-threaded Python build; with the "
+                       "GIL the pages are converted by --workers or serially")
+parser.add_option("--split-revisions", action="store", type="int",
+                  dest="splitsize", default=0,
+                  help="with --workers or --threads convert the revisions "
+                       "of pages larger than this many bytes in the tar file "
+                       "concurrently instead of the page as a whole")
+parser.add_option("--queue-size", action="store", type="int",
+                  dest="queuesize", default=16,
+                  help="the number of pages buffered between the stages "
+                       "of the pipeline used with --workers or --threads")
+parser.add_option("--serve", action="store_true", dest="serve",
+                  default=False,
+                  help="keep running and convert pages sent as "
+                       "line-delimited JSON over stdin/stdout or the socket "
+                       "given by --socket")
+parser.add_option("--socket", action="store", type="string", dest="socket",
+                  default='',
+                  help="the Unix socket to serve conversions on")
 
-(options, args) = parser.parse_args()
-
-# The tar file containing the TikiWiki file export - if not specified read from
-# stdin. stdin doesn't work at the moment and fails after you've used
-# extractfile as this returns nothing
-if len(args) > 1:
-    archive = tarfile.open(args[1])
-    # add all files in the export tar to the list of pages
-    pages = archive.getnames()
-    if options.outputfile == '':
-        outputfile = args[1].replace('.tar', '.xml')
-        # Add the current date and time to the output's XML filename.
-        now = datetime.datetime.now()
-        year = now.year
-        month = '{:02d}'.format(now.month)
-        day = '{:02d}'.format(now.day)
-        hour = '{:02d}'.format(now.hour)
-        minute = '{:02d}'.format(now.minute)
-        outputfile = outputfile[:-4] + '_' \
-                     + '{}{}{}_{}{}'.format(year, month, day, hour, minute) \
-                     + outputfile[-4:]
-    else:
-        outputfile = options.outputfile
-else:
-    pages = []
-    # if reading from stdin you can't iterate through the files again so
-    # pages is left empty and links are not corrected
-    archive = tarfile.open(name=sys.stdin.name, mode='r|', fileobj=sys.stdin)
-    # if you're reading from stdin and don't specify an output file output to
-    # stdout
-    if options.outputfile == '':
-        options.outputfile = '-'
-    outputfile = options.outputfile
-p = Parser()
-
-# Open the output channel by either setting `stdout` or opening a file.
-if options.outputfile == '-':
-    mwikixml = sys.stdout
-else:
-    mwikixml = open(outputfile, 'w', encoding='utf-8')
-    sys.stdout.write('Creating new wiki xml file ' + outputfile + '\n')
-
-# the source URL of the TikiWiki - in the form http://[your url]/tiki/
-sourceurl = args[0]
-
-# the relative address used to access pictures in TikiWiki
-imageurl = options.imageurl
+# the options of the current conversion, defaulting to the values used when
+# the script is imported
+(options, _) = parser.parse_args([])
 
-privatePages = []
-if options.privatexml != '':
-    privateparse = minidom.parse(options.privatexml)
+
+def load_private_pages(filename):
+    """
+    Read the names of the private pages not to be added to the wiki.
+
+    :param str filename: an XML dump of the TikiWiki pages table
+    :return: the list of page names
+    """
+    names = []
+    privateparse = minidom.parse(filename)
     rows = privateparse.getElementsByTagName('row')
     for row in rows:
         fields = row.getElementsByTagName('field')
         for field in fields:
             if field.getAttribute('name') == 'pageName':
-                privatePages.append(field.firstChild.data)
+                names.append(field.firstChild.data)
+    return names
 
-# fill the lookup table with the attachment information
-# a file containing an xml dump from the TikiWiki DB
-imageFilenames = {}
-imageFileIDs = {}
-if options.imagexml != '':
-    imagexml = options.imagexml
-    lookup = minidom.parse(imagexml)
+
+def load_image_lookup(filename):
+    """
+    Read the attachment information for the lookup tables.
+
+    :param str filename: a file containing an xml dump from the TikiWiki DB
+    :return: the file ID, filename and path of each attachment
+    """
+    attachments = []
+    lookup = minidom.parse(filename)
 
     rows = lookup.getElementsByTagName('row')
     for row in rows:
         imageFilename = row.getElementsByTagName('filename')
         imagePath = row.getElementsByTagName('path')
         fileID = row.getElementsByTagName('fileID')
-        imageFilenames[imageFilename.item(0).firstChild.data] \
-            = imageFileIDs[fileID.item(0).firstChild.data] \
-            = imagePath.item(0).firstChild.data
-
-# list of users who have edited pages
-authors = []
-filepages = {}
-pagecount = 0
-versioncount = 0
-
-# Start writing to the specified output.
-mwikixml.write('<mediawiki xml:lang="en">\n')
-header = '<siteinfo>\n' \
-         '<base>' + sourceurl + '</base>\n' \
-                                '</siteinfo>\n'
-mwikixml.write(header)
+        attachments.append((fileID.item(0).firstChild.data,
+                            imageFilename.item(0).firstChild.data,
+                            imagePath.item(0).firstChild.data))
+    return attachments
 
-# Set opening tags to identify file attachments (images, pdfs, etc.).
-attachment_identifiers = ['{img', '{mediaplayer']
 
-for member in archive:
-    if member.name not in privatePages:
-        # add each file in the TikiWiki export directory
-        tikifile = io.TextIOWrapper(
-            archive.extractfile(member), encoding='utf-8')
-        mimefile = p.parse(tikifile)
-        mwikixml.write('<page>\n')
-        partcount = 0
-        uploads = []
-        revisions = []
-
-        if not mimefile.is_multipart():
-            partcount = 1
-        for part in mimefile.walk():
-            revision = ''
-            if partcount == 1:
-                title = unquote(part.get_param('pagename'))
-                mwikixml.write(('<title>' + title + '</title>\n'))
-            partcount += 1
-            if part.get_params() is not None and \
-                    ('application/x-tikiwiki', '') in part.get_params():
-                versioncount += 1
-                headings = []
-                if part.get_param('lastmodified') is None:
-                    break
-                revision += '<revision>\n'
-                revision += '<id>REV_ID_PLACEHOLDER</id>\n'
-                revision += '<timestamp>' + time.strftime(
-                    '%Y-%m-%dT%H:%M:%SZ', time.gmtime(ast.literal_eval(
-                        part.get_param('lastmodified')))) + '</timestamp>\n'
-                revision += '<contributor><username>' + part.get_param(
-                    'author') + '</username></contributor>\n'
-                # add author to list of contributors to be output at the end
-                if part.get_param('author') not in authors:
-                    authors.append(part.get_param('author'))
-                revision += '<text xml:space="preserve">\n'
-                mwiki = ''
-                # we add the TikiWiki description to the page in bold and
-                # italic (much as it was in TikiWiki ) for them to function
-                # properly we need to ensure that these strings are followed
-                # by a new line the </br> is used as a placeholder and is
-                # converted to \n later
-                if part.get_param('description') not in (None, ''):
-                    mwiki += "'''''" + unquote(part.get_param('description')) \
-                             + "'''''</br>"
-                # then add the table of contents (or specify none)
-                if options.notoc:
-                    mwiki = mwiki + "__NOTOC__</br>"
+def load_rules(filename):
+    """
+    Read additional line rules for TikiWiki plugins.
+
+    The JSON file contains a list of rules as objects with the keys `open`
+    and `replace` and optionally either `close` and `separator` or
+    `pattern`, as described for `line_rules`.
+
+    :param str filename: the JSON file
+    :return: the list of rules
+    """
+    with open(filename, encoding='utf-8') as rulesfile:
+        rules = json.load(rulesfile)
+    keys = {'open', 'replace', 'close', 'separator', 'pattern'}
+    for rule in rules:
+        if not isinstance(rule, dict) or not rule.get('open') \
+                or 'replace' not in rule or set(rule) - keys \
+                or ('pattern' in rule and 'close' in rule) \
+                or ('separator' in rule and 'close' not in rule):
+            raise ValueError('invalid rule ' + json.dumps(rule) + ' in '
+                             + filename)
+    return rules
+
+
+def load_url_map(filename):
+    """
+    Read the rules rewriting the URLs of links.
+
+    A JSON file contains either an object mapping URLs to their
+    replacements or a list of rules as objects with the keys `from`, `to`
+    and optionally `match`. A CSV file contains a rule per row with the
+    columns from, to and optionally match. The match is either `exact`,
+    the default, or `prefix` to replace the beginning of URLs.
+
+    :param str filename: the JSON or CSV file
+    :return: the URL, its replacement and whether the rule replaces a
+        prefix for each rule
+    """
+    with open(filename, encoding='utf-8', newline='') as mapfile:
+        if filename.lower().endswith('.json'):
+            rules = json.load(mapfile)
+            if isinstance(rules, dict):
+                rules = [{'from': source, 'to': target}
+                         for source, target in rules.items()]
+            rows = [(rule['from'], rule['to'], rule.get('match', 'exact'))
+                    for rule in rules]
+        else:
+            rows = []
+            reader = csv.reader(mapfile)
+            for row in reader:
+                if not row or row[0].startswith('#'):
+                    continue
+                if len(row) < 2:
+                    raise ValueError(
+                        '{}:{}: expected PREFIX,REPLACEMENT[,MODE]'.format(
+                            filename, reader.line_num))
+                rows.append((row + ['exact'])[:3])
+    rules = []
+    for source, target, match in rows:
+        match = match.strip() or 'exact'
+        if match not in ('exact', 'prefix'):
+            raise ValueError('unknown match "' + match + '" of the URL rule '
+                             'for ' + source + ' in ' + filename)
+        rules.append((source.strip(), target.strip(), match == 'prefix'))
+    return rules
+
+
+def open_catalog(filename):
+    """
+    Open the SQLite catalog of pages and attachments and create its tables
+    if they don't exist yet.
+
+    :param str filename: the catalog's database file
+    :return: the connection to the catalog
+    """
+    # the connection is shared by the converter threads of `--threads`
+    connection = sqlite3.connect(filename, check_same_thread=False)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS pages (
+            title TEXT NOT NULL,
+            folded TEXT NOT NULL,
+            archive TEXT NOT NULL,
+            PRIMARY KEY (title, archive));
+        CREATE INDEX IF NOT EXISTS pages_folded ON pages (folded);
+        CREATE TABLE IF NOT EXISTS attachments (
+            file_id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            path TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS attachments_filename
+            ON attachments (filename);
+    """)
+    return connection
+
+
+def catalog_pages(archivename, names):
+    """
+    Replace the pages of an archive in the catalog.
+
+    :param str archivename: the path of the exported tar file
+    :param list[str] names: the titles of all pages in the archive
+    """
+    archivename = os.path.abspath(archivename)
+    with catalog:
+        catalog.execute('DELETE FROM pages WHERE archive = ?',
+                        (archivename,))
+        catalog.executemany(
+            'INSERT OR REPLACE INTO pages (title, folded, archive) '
+            'VALUES (?, ?, ?)',
+            ((name, name.casefold(), archivename) for name in names))
+
+
+def catalog_attachments(attachments):
+    """
+    Add or update attachments in the catalog.
+
+    :param list[tuple] attachments: the file ID, filename and path of each
+        attachment as returned by :func:`load_image_lookup`
+    """
+    with catalog:
+        catalog.executemany(
+            'INSERT OR REPLACE INTO attachments (file_id, filename, path) '
+            'VALUES (?, ?, ?)', attachments)
+
+
+def compile_pattern(pattern):
+    """
+    Compile a pattern selecting pages by name, which is either a glob or a
+    regular expression prefixed with `re:`.
+
+    :param str pattern: the glob or prefixed regular expression
+    :return: the compiled regular expression, which is searched for in the
+        page names
+    """
+    if pattern.startswith('re:'):
+        return re.compile(pattern[3:])
+    return re.compile(r'\A' + fnmatch.translate(pattern))
+
+
+def is_selected(name, sharded=True):
+    """
+    Check if a tar member is selected for conversion by `--include`,
+    `--exclude`, `--pages-from` and `--shard` and isn't private.
+
+    :param str name: the name of the tar member, which is the page title
+    :param bool sharded: whether to select only the pages of the shard
+    :return: True if the page should be converted
+    """
+    if name in privatePages:
+        return False
+    if includePatterns or selectedPages:
+        if name not in selectedPages and not any(
+                pattern.search(name) for pattern in includePatterns):
+            return False
+    if any(pattern.search(name) for pattern in excludePatterns):
+        return False
+    return not sharded or in_shard(name)
+
+
+def in_shard(name):
+    """
+    Check if a page belongs to the shard converted by this run.
+
+    Without balancing by size the pages are partitioned by the CRC-32 of
+    their names, which is the same on every machine and for every run.
+    """
+    if shardCount == 0:
+        return True
+    if shardPages is not None:
+        return name in shardPages
+    return zlib.crc32(name.encode('utf-8')) % shardCount == shardIndex
+
+
+def balance_shards(members):
+    """
+    Select the pages of the shard converted by this run, such that the
+    shards contain pages of about the same total size.
+
+    The largest pages are assigned first, each to the shard with the least
+    total size so far. Ties are broken by the names and indexes, so every
+    run computes the same partition of an archive.
+
+    :param list[tarfile.TarInfo] members: all members of the archive
+    """
+    global shardPages
+    totals = [0] * shardCount
+    shardPages = set()
+    for member in sorted((member for member in members
+                          if member.isfile() and is_selected(member.name,
+                                                             False)),
+                         key=lambda member: (-member.size, member.name)):
+        shard = totals.index(min(totals))
+        totals[shard] += member.size
+        if shard == shardIndex:
+            shardPages.add(member.name)
+
+
+def configure(opts, args):
+    """
+    Set the options and load the lookup tables shared by all conversions.
+
+    :param optparse.Values opts: the parsed command line options
+    :param list[str] args: the source URL of the TikiWiki - in the form
+        http://[your url]/tiki/ - and optionally the exported tar file
+    """
+    global options
+    global sourceurl
+    global imageurl
+    global privatePages
+    global imageFilenames
+    global imageFileIDs
+    global catalog
+    global includePatterns
+    global excludePatterns
+    global selectedPages
+    global shardIndex
+    global shardCount
+    options = opts
+    sourceurl = args[0]
+    # the relative address used to access pictures in TikiWiki
+    imageurl = options.imageurl
+    if options.privatexml != '':
+        privatePages = load_private_pages(options.privatexml)
+    includePatterns = [compile_pattern(pattern)
+                       for pattern in options.include or []]
+    excludePatterns = [compile_pattern(pattern)
+                       for pattern in options.exclude or []]
+    if options.pagesfrom != '':
+        with open(options.pagesfrom, encoding='utf-8') as titles:
+            selectedPages = set(line.strip() for line in titles
+                                if line.strip())
+    if options.shard != '':
+        shard = re.match(r'(\d+)/(\d+)$', options.shard)
+        if not shard or not 1 <= int(shard.group(1)) <= int(shard.group(2)):
+            parser.error('--shard must be given as I/N with 1 <= I <= N')
+        shardIndex = int(shard.group(1)) - 1
+        shardCount = int(shard.group(2))
+        if options.outputformat == 'tables':
+            parser.error('the IDs of --format tables are counted per run '
+                         'and can\'t be used with --shard')
+    if options.tracememory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if options.threads > 0 and getattr(sys, '_is_gil_enabled',
+                                       lambda: True)():
+        # threads would only take turns converting pages while holding the
+        # GIL and be slower than a single thread
+        sys.stderr.write('--threads requires a free-threaded Python build, '
+                         'the pages are converted '
+                         + ('by --workers' if options.workers > 0
+                            else 'serially') + '\n')
+        options.threads = 0
+    if options.rules != '':
+        compile_rules(line_rules + load_rules(options.rules))
+    if options.urlmap != '':
+        for source, target, prefix in load_url_map(options.urlmap):
+            urlMap.add(source, target, prefix)
+    if options.catalog != '':
+        catalog = open_catalog(options.catalog)
+    if options.imagexml != '':
+        attachments = load_image_lookup(options.imagexml)
+        for file_id, filename, path in attachments:
+            imageFilenames[filename] = imageFileIDs[file_id] = path
+        if catalog is not None:
+            catalog_attachments(attachments)
+
+
+def handle_request(request):
+    """
+    Convert the content of one request sent to the conversion server.
+
+    A request either contains the MIME export of a complete `page` as found
+    in the exported tar file, which is answered with the page's MediaWiki
+    XML, or the TikiWiki markup of a single revision as `text` with an
+    optional page `description`, which is answered with the converted
+    MediaWiki markup and the uploads it links.
+
+    :param dict request: the decoded JSON request
+    :return: the response to be encoded as JSON
+    """
+    state.missingAttachments = []
+    try:
+        if 'page' in request:
+            # read the page with universal newlines like pages from the tar
+            converted = convert_page(Parser().parse(
+                io.StringIO(request['page'], newline=None)))
+            response = {'title': converted['title'],
+                        'xml': format_page(converted),
+                        'uploads': converted['uploads'],
+                        'missing_attachments':
+                            converted['missing_attachments']}
+        elif 'text' in request:
+            # refer to the text as the first revision of the optionally
+            # given page title in messages
+            state.title = request.get('title', '')
+            state.partcount = 2
+            state.uploads = []
+            rotate_caches()
+            response = {'text': convert_revision(revision_markup(
+                request.get('description'), request['text']),
+                request['text'])[0], 'uploads': state.uploads}
+        else:
+            return {'error': 'request contains neither page nor text'}
+    except Exception as error:
+        return {'error': '{}: {}'.format(type(error).__name__, error)}
+    response.setdefault('missing_attachments', state.missingAttachments)
+    return response
+
+
+class ConversionRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answer line-delimited JSON requests on a connection to the server.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = handle_request(json.loads(line.decode('utf-8')))
+            except ValueError as error:
+                response = {'error': 'invalid request: {}'.format(error)}
+            self.wfile.write(
+                (json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def serve(socketpath=''):
+    """
+    Keep the lookup tables loaded and convert pages on request.
+
+    Requests and responses are line-delimited JSON, exchanged either over the
+    Unix socket `socketpath` or over stdin and stdout if no socket is given.
+
+    :param str socketpath: the path of the Unix socket to listen on
+    """
+    if socketpath != '':
+        if os.path.exists(socketpath):
+            os.remove(socketpath)
+        # stop serving on termination as well as on an interrupt
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        with socketserver.UnixStreamServer(
+                socketpath, ConversionRequestHandler) as server:
+            sys.stderr.write('Serving conversions on ' + socketpath + '\n')
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(socketpath)
+    else:
+        # Messages printed during the conversion must not be mixed into the
+        # responses, so they are sent to stderr.
+        responses = sys.stdout
+        sys.stdout = sys.stderr
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            try:
+                response = handle_request(json.loads(line))
+            except ValueError as error:
+                response = {'error': 'invalid request: {}'.format(error)}
+            responses.write(json.dumps(response) + '\n')
+            responses.flush()
+
+
+def convert_member(data):
+    """
+    Convert a page from the raw content of its tar member.
+
+    :param bytes data: the page as exported by TikiWiki
+    :return: the converted page as returned by :func:`convert_page` and
+        with `--trace-memory` the peaks of its traced `memory` by stage
+    """
+    mark = memory_mark()
+    state.memory = {}
+    state.memoryStart = mark or 0
+    tikifile = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+    mimefile = Parser().parse(tikifile)
+    memory_record('parse', mark)
+    converted = convert_page(mimefile)
+    if mark is not None:
+        converted['memory'] = state.memory
+    return converted
+
+
+def split_member(data):
+    """
+    Read the revisions of a page from the raw content of its tar member to
+    convert them separately.
+
+    :param bytes data: the page as exported by TikiWiki
+    :return: the page as returned by :func:`page_revisions` and with
+        `--trace-memory` the peak of its traced `memory` while parsing
+    """
+    mark = memory_mark()
+    state.memory = {}
+    state.memoryStart = mark or 0
+    tikifile = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+    page = page_revisions(Parser().parse(tikifile))
+    memory_record('parse', mark)
+    if mark is not None:
+        page['memory'] = state.memory
+    return page
+
+
+def convert_split_part(title, partcount, description, payload):
+    """
+    Convert one revision of a split page in a converter process or thread.
+
+    :return: the revision as returned by :func:`convert_part` and with
+        `--trace-memory` the peaks of its traced `memory` by stage
+    """
+    mark = memory_mark()
+    state.memory = {}
+    state.memoryStart = mark or 0
+    result = convert_part(title, partcount, description, payload)
+    if mark is not None:
+        result['memory'] = state.memory
+    return result
+
+
+def join_split_page(page, futures):
+    """
+    Wait for the revisions of a split page and combine them in their order.
+
+    :param dict page: the page as returned by :func:`split_member`
+    :param list futures: the futures of :func:`convert_split_part` in the
+        order of the page's revisions
+    :return: the converted page as returned by :func:`convert_member`
+    """
+    results = [future.result() for future in futures]
+    converted = assemble_page(page, results)
+    if 'memory' in page:
+        # the page's peaks are the highest of its revisions'
+        memory = page['memory']
+        for result in results:
+            for stage, peak in result['memory'].items():
+                memory[stage] = max(memory.get(stage, 0), peak)
+        converted['memory'] = memory
+    return converted
+
+
+def init_worker(opts, url, names, fileids, urls):
+    """
+    Set the configuration and lookup tables in a converter process.
+    """
+    global options
+    global sourceurl
+    global imageurl
+    global imageFileIDs
+    global urlMap
+    global catalog
+    options = opts
+    sourceurl = url
+    imageurl = options.imageurl
+    set_pages(names)
+    imageFileIDs = fileids
+    urlMap = urls
+    if options.rules != '':
+        compile_rules(line_rules + load_rules(options.rules))
+    if options.tracememory:
+        tracemalloc.start()
+    if options.catalog != '':
+        catalog = sqlite3.connect(options.catalog)
+
+
+def read_members(archive, tasks):
+    """
+    Read the pages to convert from the archive into the bounded queue `tasks`
+    and mark the end of the archive with None.
+
+    This is the reader stage of the pipeline, which runs in its own thread.
+    Errors are passed on through the queue to be raised by the converter
+    stage.
+    """
+    try:
+        for member in archive:
+            if is_selected(member.name):
+                tasks.put((member, archive.extractfile(member).read()))
+        tasks.put(None)
+    except Exception as error:
+        tasks.put(error)
+
+
+def write_output(output, chunks, errors):
+    """
+    Write the formatted pages from the bounded queue `chunks` until None is
+    received.
+
+    This is the writer stage of the pipeline, which runs in its own thread.
+    Errors are collected in `errors` to be raised by the converter stage.
+    """
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        if not errors:
+            try:
+                output.write(chunk)
+            except Exception as error:
+                errors.append(error)
+
+
+def pipelined():
+    """
+    Return whether the pages are converted in a pipeline of threads and
+    converter processes or threads.
+    """
+    return options.workers > 0 or options.threads > 0
+
+
+def convert_archive(archive):
+    """
+    Convert the pages of the archive, which are not private.
+
+    With `--workers` or `--threads` set, reading the tar members, converting
+    the pages in converter processes or threads and writing the output
+    overlap as stages of a pipeline connected by bounded queues. The pages
+    are still yielded in the order of the archive. Pages larger than
+    `--split-revisions` are read in this thread and their revisions are
+    converted as separate tasks, so a page with many large revisions uses
+    all converters.
+
+    :return: the tar members with their converted pages
+    """
+    if not pipelined():
+        for member in archive:
+            if is_selected(member.name):
+                # add each file in the TikiWiki export directory
+                yield member, convert_member(
+                    archive.extractfile(member).read())
+        return
+
+    tasks = queue.Queue(options.queuesize)
+    reader = threading.Thread(target=read_members, args=(archive, tasks),
+                              daemon=True)
+    reader.start()
+    pending = collections.deque()
+    if options.threads > 0:
+        # the threads share the lookup tables and keep the state of their
+        # conversion in `state`
+        executor = concurrent.futures.ThreadPoolExecutor(options.threads)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            options.workers, initializer=init_worker,
+            initargs=(options, sourceurl, pages, imageFileIDs, urlMap))
+    with executor:
+        while True:
+            task = tasks.get()
+            if isinstance(task, Exception):
+                raise task
+            if task is not None:
+                member, data = task
+                if 0 < options.splitsize <= member.size:
+                    page = split_member(data)
+                    futures = [executor.submit(
+                        convert_split_part, page['title'], revision['part'],
+                        revision['description'], revision['payload'])
+                        for revision in page['revisions']]
+                    pending.append((member, functools.partial(
+                        join_split_page, page, futures)))
                 else:
-                    mwiki += "__TOC__</br>"
-                mwiki += part.get_payload()
-
-                # does the validator do anything?!
-                validate = False
-                validator = HTMLChecker()
-                validator.feed(mwiki)
-                # fixes pages that end up on a single line (these were
-                # probably created by our WYSIWYG editor being used on windows
-                # and linux)
-                if not validate:
-                    mwiki = mwiki.replace('\t', '    ')
-                    mwiki = mwiki.replace('  ', ' &nbsp;')
-                    mwiki = mwiki.replace('<', '&lt;')
-                    mwiki = mwiki.replace('>', '&gt;')
-
-                    # make sure newlines after headings are preserved
-                    next_elem = 0
-                    while '\r\n!' in mwiki[next_elem:] or '&lt;/br&gt;!' in \
-                            mwiki[next_elem:] or mwiki[
-                                                 next_elem:].startswith('!'):
-                        if mwiki[next_elem:].startswith('!'):
-                            found = next_elem
-                        else:
-                            foundreturn = mwiki.find('\r\n!', next_elem)
-                            foundbreak = mwiki.find('&lt;/br&gt;!', next_elem)
-                            if (foundreturn != -1 and foundreturn <
-                                foundbreak) or foundbreak == -1:
-                                found = foundreturn + 2
-                            else:
-                                found = foundbreak + 11
-
-                        next_elem = mwiki.find('\r\n', found)
-                        if next_elem == -1:
-                            break
-                        mwiki = mwiki[:next_elem] + '</br>' + mwiki[next_elem
-                                                                    + 2:]
-                        next_elem += 5
-
-                    # as validate is false the page does not contain any html
-                    # so whitespace needs to be preserved
-                    mwiki = mwiki.replace('\r\n', '</br>')
-
-                # double escape < and > entities so that &lt; is not
-                # unescaped to < which is then treated as HTML tags
-                mwiki = mwiki.replace('&amp;lt;', '&amp;amp;lt;')
-                mwiki = mwiki.replace('&amp;gt;', '&amp;amp;gt;')
-                mwiki = mwiki.replace('&lt;', '&amp;lt;')
-                mwiki = mwiki.replace('&gt;', '&amp;gt;')
-                mwiki = mwiki.replace(u'\ufffd', '&nbsp;')
-
-                # unescape XML entities
-                entitydefs = dict(("&" + k + ";", chr(v)) for k, v in
-                                  htmlentitydefs.name2codepoint.items())
-                entitydefs.pop("&amp;")
-                entitydefs.pop("&gt;")
-                entitydefs.pop("&lt;")
-                mwiki = unescape(mwiki, entitydefs)
-
-                # replace TikiWiki syntax that will be interpreted badly with
-                # TikiWiki syntax the parser will understand empty formatting
-                # tags will be converted to many "'"s which then confuses
-                # MediaWiki
-                mwiki = mwiki.replace('[[', '~np~[~/np~')
-                # need to replace no wiki tags here in case any html/xml is
-                # inside them that we want to keep
-                mwiki = mwiki.replace('~np~', '<nowiki>')
-                mwiki = mwiki.replace('~/np~', '</nowiki>')
-                mwiki = mwiki.replace('<em></em>', '')
-                mwiki = mwiki.replace('<em><em>', '<em>')
-                mwiki = mwiki.replace('</em></em>', '</em>')
-                mwiki = mwiki.replace('<strong></strong>', '')
-                mwiki = mwiki.replace('<strong><strong>', '<strong>')
-                mwiki = mwiki.replace('</strong></strong>', '</strong>')
-                # this makes sure definitions keep their preceding newline
-                mwiki = mwiki.replace('\n;', '</br>;')
-                mwiki = mwiki.replace('</br>', '\n')
-                mwiki = mwiki.replace('&lt;/br&gt;', '\n')
-                mwiki = mwiki.replace('\r', ' ')
-                mwiki = mwiki.replace('\t', ' ')
-
-                # Mediawiki automatically creates a table of content
-                mwiki = mwiki.replace('Table of content', '')
-                mwiki = mwiki.replace('{maketoc}', '')
-
-                # convert === underline syntax before the html converter as
-                # headings in MediaWiki use =s and h3 tags will become
-                # ===heading===
-                next_elem = 0
-                while '===' in mwiki[next_elem:]:
-                    start = mwiki.find('===', next_elem)
-                    end = mwiki.find('===', start + 3)
+                    pending.append(
+                        (member, executor.submit(convert_member,
+                                                 data).result))
+            # keep at most `queuesize` pages in conversion and hand them on
+            # in the order of the archive
+            while pending and (task is None
+                               or len(pending) >= options.queuesize):
+                member, result = pending.popleft()
+                yield member, result()
+            if task is None:
+                break
+    reader.join()
+
+
+# the TikiWiki constructs counted when analyzing an archive
+analyzed_constructs = {'img': '{img', 'links': '((', 'code': '{CODE(',
+                       'html': '{HTML()}', 'nowiki': '~np~'}
+
+
+def distribution(sizes):
+    """
+    Summarize a list of sizes by their total, minimum, maximum and
+    percentiles.
+    """
+    sizes = sorted(sizes)
+    if not sizes:
+        return {'count': 0, 'total': 0}
 
-                    if end != -1:
-                        mwiki = mwiki[:start] + '<u>' + mwiki[start + 3:end] \
-                                + '</u>' + mwiki[end + 3:]
-                    next_elem = start + 1
-                # if there is another === convert them both
-
-                # print mwiki
-
-                wikitext = []
-
-                # convert any HTML tags to MediaWiki syntax
-                htmlConverter = HTMLToMwiki()
-                htmlConverter.feed(mwiki)
-
-                mwiki = ''.join(wikitext)
-
-                # replace TikiWiki syntax with MediaWiki
-                mwiki = mwiki.replace('__', "'''")
-
-                # split the text into lines and then strings to parse
-                words = []
-                # Set variables to mark current enclosing TikiWiki environment
-                processing_attachment = False
-                intLink = False
-                box = False
-                colour = False
-                inColourTag = False
-                inFormula = False
-                page = ''
-                centre = False
-                for line in mwiki.splitlines(True):
-                    # Convert external links to MediaWiki syntax
-                    m = re.match(r'(.*)\[(.*)\|(.*)\](.*)', line)
-                    if m:
-                        line = m.group(1) + "[" + re.sub(
-                            r'(.*)&amp;(.*);('r'.*)', r'\1&\2\3', m.group(2)) \
-                               + " " + m.group(3) + "]" + m.group(4) + "\n"
-
-                    # Convert 'CODE' samples to MediaWiki syntax
-                    line = re.sub(r'{CODE\(caption=&amp;gt;(.*)\)}',
-                                  r'<!-- \1 --><source>', line)
-                    line = re.sub(r'{CODE\((.*)\)}',
-                                  r'<source>', line)
-                    line = re.sub(r'{CODE}', r'</source>', line)
-
-                    # Convert anchor
-                    line = re.sub(r'{ANAME\(\)}(.*){ANAME}',
-                                  r'<span id=&quot;\1&quot;></span>', line)
-                    # Convert anchor links
-                    line = re.sub(r'{ALINK\(aname=(?:")?([^"]*)(?:")?\)}('
-                                  r'.*){ALINK}', r'[[#\1|\2]]', line)
-
-                    heading = False
-                    noCentre = False
-
-                    # Convert formulas based on the MathJax macro.
-                    if re.search(r'{HTML\(\)}', line):
-                        inFormula = True
-                        line = re.sub(r'{HTML\(\)}',
-                                      r'<macro:mathjax>', line)
-                        line = re.sub(r'{HTML\(\)}', '<macro:mathjax>', line)
-                        # line = re.sub(r'\\[(,\[]', '', line)
-                    if re.search(r'{HTML}', line):
-                        inFormula = False
-                        line = re.sub(r'{HTML}',
-                                      r'</macro:mathjax>', line)
-                        line = re.sub(r'{HTML}', r'</macro:mathjax>', line)
-
-                    # if there are an odd no. of ::s don't convert to
-                    # centered text
-                    if line.count('::') % 2 != 0:
-                        noCentre = True
-                    count = 0
-                    spl = line.split(' ')
-                    if spl[0].find('!') == 0:
-                        heading = True
-                    for elem in spl:
-                        # handle headings
-                        if heading is True:
-                            if count is 0 and elem:
-                                # replace !s
-                                bangs = 0
-                                while elem[bangs] == '!':
-                                    elem = elem.replace('!', '=', 1)
-                                    bangs += 1
-                                    if bangs >= len(elem):
-                                        if len(spl) == 1:
-                                            bangs /= 2
-                                        break
-                            if count is len(spl) - 1:
-                                # add =s to end
-                                end = elem.find('\n')
-                                if end != -1:
-                                    elem = elem[:end] + (bangs * '=') + elem[
-                                                                        end:]
-                                else:
-                                    elem = elem[:end] + (bangs * '=')
-                        # handle centered text
-                        if '::' in elem and not noCentre:
-                            next_elem = 0
-                            while '::' in elem[next_elem:]:
-                                next_elem = elem.find('::')
-                                if centre:
-                                    centre = False
-                                    elem = elem.replace('::', '</center>', 1)
-                                else:
-                                    centre = True
-                                    elem = elem.replace('::', '<center>', 1)
-                        # handle font colours
-                        if inColourTag:
-                            colon = elem.find(':')
-                            if colon != -1:
-                                elem = elem[:colon] + '">' + elem[colon + 1:]
-                                inColourTag = False
-                        if '~~' in elem:
-                            next_elem = 0
-                            while '~~' in elem[next_elem:]:
-                                next_elem = elem.find('~~')
-                                if colour:
-                                    # end span
-                                    colour = False
-                                    elem = elem.replace('~~', '</span>', 1)
-                                else:
-                                    # start span
-                                    colour = True
-                                    colon = elem.find(':', next_elem)
-                                    extratext = ''
-                                    if colon != -1:
-                                        elem = elem[:next_elem] \
-                                               + "<span style='color:" \
-                                               + elem[next_elem + 2:colon] \
-                                               + "'>" + elem[colon + 1:]
-                                    else:
-                                        elem = elem[:next_elem] \
-                                               + '<span style="color:' \
-                                               + elem[next_elem + 2:]
-                                        inColourTag = True
-                                next_elem += 1
-                        if any(tag in elem for tag in attachment_identifiers):
-                            processing_attachment = True
-                        if processing_attachment:
-                            words, processing_attachment = process_image(
-                                elem, attachment_identifiers)
-                        elif intLink:
-                            insert_link(elem)
-                        else:
-                            # stops MediaWiki automatically creating links (
-                            # which can then be broken by formatting
-                            if ('http' in elem or 'ftp://' in elem) and '[' \
-                                    not in elem and ']' not in elem and \
-                                    '<pic>' not in elem and '<pre>' not in \
-                                    elem and '</pre>' not in elem and not box:
-                                index = 0
-                                do_format = False
-                                formatted = ''
-                                for char in elem:
-                                    index += 1
-                                    if char == "'":
-                                        if not do_format:
-                                            do_format = True
-                                            formatted = formatted + '</nowiki>'
-                                    else:
-                                        if do_format:
-                                            do_format = False
-                                            formatted = formatted + '<nowiki>'
-
-                                    formatted += char
-
-                                elem = '<nowiki>' + formatted + '</nowiki>'
-                            if elem != '':
-                                if '\n' in elem[-1]:
-                                    words.append(elem)
-                                else:
-                                    words.append(elem + ' ')
-                        count += 1
-
-                mwiki = ''.join(words)
-                # get rid of pic placeholder tags
-                mwiki = mwiki.replace("<pic>", "")
-                mwiki = mwiki.replace("</pic>", "")
-
-                # make sure there are no single newlines - MediaWiki just
-                # ignores them. Replace multiple lines with single and then
-                # single with double.
-                while "\n \n" in mwiki:
-                    mwiki = mwiki.replace("\n \n", "\n")
-                while "\n\n" in mwiki:
-                    mwiki = mwiki.replace("\n\n", "\n")
-                mwiki = mwiki.replace('\n', '\n\n')
-
-                # Add one space to bullet points.
-                mwiki = mwiki.replace('\n*', '\n* ')
-
-                # replace multiple lines with single where they would break
-                # formatting - such as in a list
-                mwiki = mwiki.replace('\n\n#', '\n#')
-                mwiki = mwiki.replace('\n\n*', '\n*')
-                mwiki = mwiki.replace('*<br/>', '*')
-                mwiki = mwiki.replace('#<br/>', '#')
-                mwiki = mwiki.lstrip('\n')
-
-                lines = []
-                for line in mwiki.splitlines(True):
-                    if line.startswith(':'):
-                        line = '<nowiki>:</nowiki>' + line[1:]
-                    lines.append(line)
-                mwiki = ''.join(lines)
-
-                entitydefs = dict((chr(k), "&amp;" + v + ";") for k, v in
-                                  htmlentitydefs.codepoint2name.items())
-                entitydefs.pop('<')
-                entitydefs.pop('>')
-                entitydefs.pop('&')
-                entitydefs['|'] = '&#124;'
-                mwiki = escape(mwiki, entitydefs)
-
-                for index, value in enumerate(mwiki):
-                    if value < " " and value != '\n' and value != \
-                            '\r' and value != '\t':
-                        mwiki = mwiki[:index] + "?" + mwiki[index + 1:]
-
-                mwiki = mwiki.replace('amp;lt;', 'lt;')
-                mwiki = mwiki.replace('amp;gt;', 'gt;')
-
-                # Replace double spaces by single space.
-                while "  " in mwiki:
-                    mwiki = mwiki.replace("  ", " ")
-                mwiki = mwiki.replace('&lt;!--', '<!--')
-                mwiki = mwiki.replace('--&gt;', '-->')
-
-                mwiki = mwiki.replace("'''TOC'''", '__TOC__')
-                mwiki = mwiki.replace("'''NOTOC'''", '__NOTOC__')
-
-                revision += mwiki + '</text>\n'
-                revision += '</revision>\n'
-                revisions.append(revision)
+    def percentile(fraction):
+        return sizes[min(len(sizes) - 1, int(fraction * len(sizes)))]
+
+    return {'count': len(sizes), 'total': sum(sizes), 'min': sizes[0],
+            'median': percentile(0.5), 'p90': percentile(0.9),
+            'p99': percentile(0.99), 'max': sizes[-1]}
+
+
+def analyze_archive(archive, sample=0):
+    """
+    Analyze the selected pages of an archive without converting them.
+
+    The revisions are parsed as for the conversion and counted, their sizes
+    and constructs are recorded and they are checked for HTML. Optionally a
+    random sample of pages is converted to extrapolate the runtime of a full
+    conversion from the time per byte.
+
+    :param tarfile.TarFile archive: the exported tar file
+    :param int sample: the number of pages to convert
+    :return: the analysis as a dict
+    """
+    pagesizes = []
+    revisionsizes = []
+    revisioncount = 0
+    htmlcount = 0
+    constructs = dict((name, 0) for name in analyzed_constructs)
+    # a uniformly drawn sample of the pages' content, which works for
+    # archives read from stdin as well
+    sampled = []
+    choose = random.Random()
+    for member in archive:
+        if not is_selected(member.name):
+            continue
+        data = archive.extractfile(member).read()
+        pagesizes.append(len(data))
+        if len(pagesizes) <= sample:
+            sampled.append(data)
+        else:
+            index = choose.randrange(len(pagesizes))
+            if index < sample:
+                sampled[index] = data
+        tikifile = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+        for part in Parser().parse(tikifile).walk():
+            if part.get_params() is None or \
+                    ('application/x-tikiwiki', '') not in part.get_params():
+                continue
+            if part.get_param('lastmodified') is None:
+                break
+            payload = part.get_payload()
+            revisioncount += 1
+            revisionsizes.append(len(payload.encode('utf-8')))
+            if contains_html(payload):
+                htmlcount += 1
+            for name, construct in analyzed_constructs.items():
+                constructs[name] += payload.count(construct)
+
+    analysis = {
+        'pages': len(pagesizes),
+        'revisions': revisioncount,
+        'page_bytes': distribution(pagesizes),
+        'revision_bytes': distribution(revisionsizes),
+        'html_revisions': htmlcount,
+        'tiki_revisions': revisioncount - htmlcount,
+        'constructs': constructs,
+    }
+    if sampled:
+        start = time.time()
+        for data in sampled:
+            convert_member(data)
+        seconds = time.time() - start
+        samplebytes = sum(len(data) for data in sampled)
+        analysis['sample'] = {
+            'pages': len(sampled),
+            'bytes': samplebytes,
+            'seconds': round(seconds, 3),
+            'estimated_seconds': round(
+                seconds * sum(pagesizes) / max(samplebytes, 1), 3),
+        }
+    return analysis
+
+
+def format_analysis(analysis):
+    """
+    Format the analysis of an archive as a report to be read by humans.
+    """
+    lines = ['number of pages = {} number of versions = {}'.format(
+        analysis['pages'], analysis['revisions'])]
+    for key, label in (('page_bytes', 'page size'),
+                       ('revision_bytes', 'revision size')):
+        sizes = analysis[key]
+        if sizes['count']:
+            lines.append('{} in bytes: total {total}, min {min}, median '
+                         '{median}, 90% {p90}, 99% {p99}, max {max}'.format(
+                             label, **sizes))
+    if analysis['revisions']:
+        lines.append('revisions with HTML = {} ({:.1f}%), plain TikiWiki = '
+                     '{}'.format(analysis['html_revisions'],
+                                 100.0 * analysis['html_revisions']
+                                 / analysis['revisions'],
+                                 analysis['tiki_revisions']))
+    lines.append('constructs: ' + ', '.join(
+        '{} {}'.format(analyzed_constructs[name], count)
+        for name, count in analysis['constructs'].items()))
+    if 'sample' in analysis:
+        lines.append('converting a sample of {pages} pages ({bytes} bytes) '
+                     'took {seconds} s, the estimated time for all pages is '
+                     '{estimated_seconds} s'.format(**analysis['sample']))
+    return '\n'.join(lines) + '\n'
+
+
+merge_parser = OptionParser(
+    usage="usage: %prog merge [options] SHARD.xml ... [SHARD.json ...]")
+merge_parser.add_option("-o", "--outputfile", action="store", type="string",
+                        dest="outputfile", default='-',
+                        help="the merged MediaWiki XML file, stdout if not "
+                             "given")
+merge_parser.add_option("--summary-json", action="store", type="string",
+                        dest="summaryjson", default='',
+                        help="write the merged summaries of the shards given "
+                             "as .json files to this file")
+
+
+def index_pages(filename):
+    """
+    Find the pages in the MediaWiki XML written for a shard without loading
+    the complete file.
+
+    :param str filename: the XML file of the shard
+    :return: the document's header preceding the pages and the title,
+        offset and length of each page
+    """
+    header = b''
+    entries = []
+    offset = 0
+    start = None
+    title = None
+    with open(filename, 'rb') as shard:
+        for line in shard:
+            # the shard might have been written with Windows line endings
+            tag = line.rstrip(b'\r\n')
+            # text is escaped, so these lines only delimit pages
+            if tag == b'<page>':
+                start = offset
+            elif start is None:
+                if not entries and tag != b'</mediawiki>':
+                    header += line
+            elif title is None and tag.startswith(b'<title>'):
+                title = tag[len(b'<title>'):-len(b'</title>')] \
+                    .decode('utf-8')
+            elif tag == b'</page>':
+                entries.append((title, start, offset + len(line) - start))
+                start = title = None
+            offset += len(line)
+    return header, entries
+
+
+def merge_shards(filenames, output):
+    """
+    Combine the MediaWiki XML of several shards into one document with the
+    pages in the order of their titles.
+
+    The header is taken from the first shard. A page found in several
+    shards is only written once.
+
+    :param list[str] filenames: the XML files of the shards
+    :param output: the binary file to write the merged document to
+    :return: the number of pages written
+    """
+    header = None
+    pageIndex = {}
+    for filename in filenames:
+        shardHeader, entries = index_pages(filename)
+        if header is None:
+            header = shardHeader
+        for title, offset, length in entries:
+            if title in pageIndex:
+                sys.stderr.write('The page "' + title + '" of ' + filename
+                                 + ' was already merged from '
+                                 + pageIndex[title][0] + '\n')
             else:
-                if partcount != 1:
-                    if not sys.stdout:
-                        sys.stdout.write(str(
-                            part.get_param('pagename')) + ' version ' + str(
-                            part.get_param('version')) + ' wasn\'t counted')
-
-        # Write the contents of `revisions` to the specified output in
-        # reverse order to get newest entry last. That maybe unimportant to
-        # MediaWiki, but importing the result to XWiki as MediaWiki-Export
-        # requires this sorting.
-        while revisions:
-            revision = str(revisions.pop(-1))
-            if revisions:
-                revision = revision.replace(
-                    '<id>REV_ID_PLACEHOLDER</id>\n',
-                    '<id>' + str(len(revisions) + 1) + '</id>\n<parentid>' +
-                    str(len(revisions)) + '</parentid>\n')
+                pageIndex[title] = (filename, offset, length)
+    output.write(header or b'<mediawiki xml:lang="en">\n')
+    shards = {}
+    try:
+        for title in sorted(pageIndex):
+            filename, offset, length = pageIndex[title]
+            if filename not in shards:
+                shards[filename] = open(filename, 'rb')
+            shards[filename].seek(offset)
+            output.write(shards[filename].read(length))
+    finally:
+        for shard in shards.values():
+            shard.close()
+    output.write(b'</mediawiki>\n')
+    return len(pageIndex)
+
+
+def merge_summaries(summaries):
+    """
+    Combine the summaries written by `--summary-json` for several shards.
+
+    Counts are added up, the contributors are listed in the order they are
+    found in the shards and the timings span all shards with the seconds
+    adding up to the total conversion time.
+
+    :param list[dict] summaries: the summaries of the shards
+    :return: the summary of all shards
+    """
+    merged = {'pages': 0, 'revisions': 0, 'skipped_revisions': 0,
+              'revisions_per_page': {}, 'contributors': [], 'uploads': {},
+              'missing_attachments': [], 'over_budget_revisions': [],
+              'timings': {}}
+    for summary in summaries:
+        for key in ('pages', 'revisions', 'skipped_revisions'):
+            merged[key] += summary.get(key, 0)
+        merged['revisions_per_page'].update(
+            summary.get('revisions_per_page', {}))
+        merged['uploads'].update(summary.get('uploads', {}))
+        if 'memory_peaks' in summary:
+            merged.setdefault('memory_peaks', {}).update(
+                summary['memory_peaks'])
+        for key in ('contributors', 'missing_attachments'):
+            for item in summary.get(key, []):
+                if item not in merged[key]:
+                    merged[key].append(item)
+        merged['over_budget_revisions'].extend(
+            summary.get('over_budget_revisions', []))
+        if 'not_well_formed' in summary:
+            merged.setdefault('not_well_formed', []).extend(
+                summary['not_well_formed'])
+        timings = summary.get('timings')
+        if timings:
+            merged['timings'] = {
+                'start': min(timings['start'],
+                             merged['timings'].get('start', timings['start'])),
+                'end': max(timings['end'],
+                           merged['timings'].get('end', timings['end'])),
+                'seconds': round(merged['timings'].get('seconds', 0)
+                                 + timings['seconds'], 3),
+            }
+    merged['revisions_per_page'] = dict(
+        sorted(merged['revisions_per_page'].items()))
+    merged['uploads'] = dict(sorted(merged['uploads'].items()))
+    return merged
+
+
+def merge(argv):
+    """
+    Run the `merge` subcommand combining the output of shards converted with
+    `--shard`.
+    """
+    (opts, args) = merge_parser.parse_args(argv)
+    xmlfiles = [name for name in args if not name.endswith('.json')]
+    jsonfiles = [name for name in args if name.endswith('.json')]
+    if not xmlfiles:
+        merge_parser.error('the XML files of the shards are missing')
+    if opts.outputfile == '-':
+        pagecount = merge_shards(xmlfiles, sys.stdout.buffer)
+        sys.stdout.flush()
+    else:
+        with open(opts.outputfile, 'wb') as output:
+            pagecount = merge_shards(xmlfiles, output)
+    sys.stderr.write('merged ' + str(pagecount) + ' pages of '
+                     + str(len(xmlfiles)) + ' shards\n')
+    if opts.summaryjson != '':
+        summaries = []
+        for filename in jsonfiles:
+            with open(filename, encoding='utf-8') as summaryfile:
+                summaries.append(json.load(summaryfile))
+        with open(opts.summaryjson, 'w', encoding='utf-8') as summaryfile:
+            json.dump(merge_summaries(summaries), summaryfile, indent=2,
+                      ensure_ascii=False)
+
+
+def format_memory(pageMemory, top=10):
+    """
+    Format the pages with the largest peaks of traced memory as a report to
+    be read by humans.
+
+    :param dict pageMemory: the peaks of each page by stage in bytes
+    :param int top: the number of pages to report
+    """
+    lines = ['largest peaks of traced memory per page in KiB:']
+    if not hasattr(tracemalloc, 'reset_peak'):
+        lines.append('(the peaks are cumulative as Python < 3.9 can\'t '
+                     'reset them)')
+    peaks = sorted(pageMemory.items(),
+                   key=lambda item: -item[1].get('page', 0))
+    for title, memory in peaks[:top]:
+        lines.append('{}: {} ({})'.format(
+            title, memory.get('page', 0) // 1024, ', '.join(
+                '{} {}'.format(stage, memory[stage] // 1024)
+                for stage in ('parse', 'html', 'inline', 'emit')
+                if stage in memory)))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    if sys.argv[1:2] == ['merge']:
+        merge(sys.argv[2:])
+        return
+    (opts, args) = parser.parse_args()
+    configure(opts, args)
+
+    if options.serve:
+        # the names of the pages in an optionally given tar file are used to
+        # correct the case of links
+        if len(args) > 1:
+            with tarfile.open(args[1]) as archive:
+                set_pages(archive.getnames())
+            if catalog is not None:
+                catalog_pages(args[1], pages)
+        serve(options.socket)
+        return
+
+    # The tar file containing the TikiWiki file export - if not specified
+    # read from stdin. stdin doesn't work at the moment and fails after
+    # you've used extractfile as this returns nothing
+    if len(args) > 1:
+        archive = tarfile.open(args[1])
+        # add all files in the export tar to the list of pages
+        set_pages(archive.getnames())
+        if catalog is not None:
+            catalog_pages(args[1], pages)
+        if shardCount and options.shardby == 'size':
+            balance_shards(archive.getmembers())
+        if options.outputfile == '':
+            outputfile = args[1].replace('.tar', {
+                'xar': '.xar', 'tables': '.tsv'}.get(options.outputformat,
+                                                     '.xml'))
+            # Add the current date and time to the output's XML filename.
+            now = datetime.datetime.now()
+            year = now.year
+            month = '{:02d}'.format(now.month)
+            day = '{:02d}'.format(now.day)
+            hour = '{:02d}'.format(now.hour)
+            minute = '{:02d}'.format(now.minute)
+            outputfile = outputfile[:-4] + '_' \
+                + '{}{}{}_{}{}'.format(year, month, day, hour, minute) \
+                + outputfile[-4:]
+            if options.outputformat in ('tables', 'pages'):
+                # the tables and pages are written to a directory
+                outputfile = outputfile[:-4]
+        else:
+            outputfile = options.outputfile
+    else:
+        # if reading from stdin you can't iterate through the files again so
+        # pages is left empty and links are only corrected if they are in
+        # the catalog
+        if shardCount and options.shardby == 'size':
+            parser.error('--shard-by size requires the tar file')
+        archive = tarfile.open(name=sys.stdin.name, mode='r|',
+                               fileobj=sys.stdin)
+        # if you're reading from stdin and don't specify an output file
+        # output to stdout
+        if options.outputfile == '':
+            options.outputfile = '-'
+        outputfile = options.outputfile
+
+    if options.analyze:
+        analysis = analyze_archive(archive, options.sample)
+        sys.stdout.write(format_analysis(analysis))
+        if options.summaryjson != '':
+            with open(options.summaryjson, 'w',
+                      encoding='utf-8') as summaryfile:
+                json.dump(analysis, summaryfile, indent=2)
+        return
+
+    header = '<siteinfo>\n' \
+             '<base>' + sourceurl + '</base>\n' \
+             '</siteinfo>\n'
+
+    # Open the output channel by either setting `stdout` or opening a file.
+    if options.outputformat == 'pages':
+        if outputfile == '-':
+            parser.error('--format pages requires the output directory -o')
+        # the index of each shard is written into the same directory
+        index = 'index.tsv'
+        if shardCount:
+            index = 'index_{}_of_{}.tsv'.format(shardIndex + 1, shardCount)
+        mwikixml = PageDirectory(
+            outputfile, header, index,
+            max(options.workers, options.threads, 1))
+        sys.stdout.write('Creating new page directory ' + outputfile + '\n')
+    elif options.outputformat == 'tables':
+        if outputfile == '-':
+            parser.error('--format tables requires the output directory -o')
+        mwikixml = TableWriter(outputfile)
+        sys.stdout.write('Creating new tables in ' + outputfile + '\n')
+    elif options.outputformat == 'xar':
+        if options.outputfile == '-':
+            mwikixml = XarPackage(sys.stdout.buffer)
+            # the package is binary, so any text is written to stderr
+            # instead of being appended to it
+            sys.stdout = sys.stderr
+        else:
+            mwikixml = XarPackage(open(outputfile, 'wb'))
+            sys.stdout.write('Creating new XAR package ' + outputfile + '\n')
+    elif options.outputfile == '-':
+        mwikixml = sys.stdout
+    else:
+        mwikixml = open(outputfile, 'w', encoding='utf-8')
+        sys.stdout.write('Creating new wiki xml file ' + outputfile + '\n')
+
+    # list of users who have edited pages
+    authors = []
+    filepages = {}
+    pagecount = 0
+    versioncount = 0
+    skippedcount = 0
+    # number of revisions per page title and the IDs of attachments which
+    # are referenced but missing in the image XML, both for the run summary
+    pageRevisions = {}
+    # the peaks of traced memory of each page by stage
+    pageMemory = {}
+    missingAttachments = []
+    overBudget = []
+    startTime = time.time()
+
+    progress = None
+    if options.progress:
+        if pages:
+            members = [member for member in archive.getmembers()
+                       if member.isfile() and is_selected(member.name)]
+            progress = ProgressReporter(
+                len(members), sum(member.size for member in members))
+        else:
+            progress = ProgressReporter()
+
+    # The validator checks the XML of every page in its own thread.
+    validator = None
+    if options.validatexml:
+        validator = XmlValidator(options.queuesize)
+
+    # Start writing to the specified output.
+    if options.outputformat == 'mediawiki':
+        mwikixml.write('<mediawiki xml:lang="en">\n')
+        mwikixml.write(header)
+        if validator:
+            validator.check(None, header)
+
+    # With the pipeline the output is written by its own thread, which
+    # receives the formatted pages through a bounded queue.
+    writeErrors = []
+    if pipelined():
+        chunks = queue.Queue(options.queuesize)
+        writer = threading.Thread(target=write_output,
+                                  args=(mwikixml, chunks, writeErrors))
+        writer.start()
+    try:
+        for member, converted in convert_archive(archive):
+            versioncount += converted['versions']
+            skippedcount += converted['skipped']
+            # add authors to list of contributors to be output at the end
+            for revision in converted['revisions']:
+                if revision['author'] not in authors:
+                    authors.append(revision['author'])
+            # the page is formatted in this thread, which adds the
+            # emission to the page's traced memory
+            state.memory = converted.get('memory', {})
+            mark = memory_mark()
+            state.memoryStart = mark or 0
+            if options.outputformat == 'tables':
+                xml = mwikixml.format(converted)
+            elif options.outputformat == 'xar':
+                xml = format_xwiki_page(converted, options.xarspace)
+            elif options.outputformat == 'pages':
+                xml = converted['title'], format_page(converted)
+            else:
+                xml = format_page(converted)
+            memory_record('emit', mark)
+            if mark is not None:
+                pageMemory[converted['title']] = state.memory
+            if validator and xml is not None \
+                    and options.outputformat != 'tables':
+                validator.check(converted['title'], xml[1]
+                                if options.outputformat in ('xar', 'pages')
+                                else xml)
+            if pipelined():
+                if writeErrors:
+                    raise writeErrors[0]
+                chunks.put(xml)
             else:
-                revision = revision.replace(
-                    '<id>REV_ID_PLACEHOLDER</id>\n',
-                    '<id>' + str(len(revisions) + 1) + '</id>\n')
-
-            mwikixml.write(revision)
-
-        mwikixml.write('</page>\n')
-        if uploads:
-            filepages[title] = uploads
-        pagecount += 1
-mwikixml.write('</mediawiki>\n')
-sys.stdout.write('\nnumber of pages = ' + str(pagecount)
-                 + ' number of versions = ' + str(versioncount) + '\n')
-sys.stdout.write('with contributions by ' + str(authors) + '\n')
-sys.stdout.write(
-    'and file uploads on these pages: ' + str(filepages.keys()) + '\n')
+                mwikixml.write(xml)
+            if converted['uploads']:
+                filepages[converted['title']] = converted['uploads']
+            for file_id in converted['missing_attachments']:
+                if file_id not in missingAttachments:
+                    missingAttachments.append(file_id)
+            overBudget.extend(converted['over_budget'])
+            pageRevisions[converted['title']] = converted['versions']
+            pagecount += 1
+            if progress:
+                progress.update(1, converted['versions'], member.size)
+    finally:
+        if pipelined():
+            chunks.put(None)
+            writer.join()
+    if writeErrors:
+        raise writeErrors[0]
+    if options.outputformat != 'mediawiki':
+        mwikixml.close()
+    else:
+        mwikixml.write('</mediawiki>\n')
+    malformedPages = validator.close() if validator else []
+    if progress:
+        progress.report()
+    sys.stdout.write('\nnumber of pages = ' + str(pagecount)
+                     + ' number of versions = ' + str(versioncount) + '\n')
+    sys.stdout.write('with contributions by ' + str(authors) + '\n')
+    sys.stdout.write(
+        'and file uploads on these pages: ' + str(filepages.keys()) + '\n')
+    if options.tracememory:
+        sys.stdout.write(format_memory(pageMemory))
+
+    if options.summaryjson != '':
+        endTime = time.time()
+        summary = {
+            'pages': pagecount,
+            'revisions': versioncount,
+            'skipped_revisions': skippedcount,
+            'revisions_per_page': pageRevisions,
+            'contributors': authors,
+            'uploads': filepages,
+            'missing_attachments': missingAttachments,
+            'over_budget_revisions': overBudget,
+            'timings': {
+                'start': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                       time.gmtime(startTime)),
+                'end': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                     time.gmtime(endTime)),
+                'seconds': round(endTime - startTime, 3),
+            },
+        }
+        if options.tracememory:
+            summary['memory_peaks'] = pageMemory
+        if options.validatexml:
+            summary['not_well_formed'] = malformedPages
+        with open(options.summaryjson, 'w', encoding='utf-8') as summaryfile:
+            json.dump(summary, summaryfile, indent=2, ensure_ascii=False)
+    if malformedPages:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Send TikiWiki pages to a running conversion server started by
+#
+#     tikiToMwiki.py --serve --socket SOCKET SOURCEURL [TARFILE]
+#
+# and write the converted MediaWiki XML or markup to stdout. The client only
+# uses the standard library, so it starts quickly and leaves the expensive
+# setup to the server.
+#
+# © copyright PTB 2019, T. Bruns, B.Ludwig
+
+import json
+import socket
+import sys
+from optparse import OptionParser
+
+parser = OptionParser(usage="usage: %prog [options] SOCKET [FILE ...]")
+parser.add_option("-t", "--text", action="store_true", dest="text",
+                  default=False,
+                  help="the files contain the TikiWiki markup of a single "
+                       "revision instead of a page exported by TikiWiki")
+parser.add_option("-d", "--description", action="store", type="string",
+                  dest="description", default='',
+                  help="the page description to prepend to revision markup")
+
+
+def main():
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error('the socket of the conversion server is missing')
+
+    # read the files to convert or a single page from stdin
+    contents = []
+    if len(args) > 1:
+        for filename in args[1:]:
+            with open(filename, encoding='utf-8') as tikifile:
+                contents.append(tikifile.read())
+    else:
+        contents.append(sys.stdin.read())
+
+    failed = False
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(args[0])
+    with connection, connection.makefile('rwb') as channel:
+        for content in contents:
+            if options.text:
+                request = {'text': content,
+                           'description': options.description}
+            else:
+                request = {'page': content}
+            channel.write((json.dumps(request) + '\n').encode('utf-8'))
+            channel.flush()
+            response = json.loads(channel.readline().decode('utf-8'))
+            if 'error' in response:
+                sys.stderr.write(response['error'] + '\n')
+                failed = True
+            else:
+                sys.stdout.write(response.get('xml', response.get('text')))
+            for file_id in response.get('missing_attachments', []):
+                sys.stderr.write('The attachment with ID ' + file_id
+                                 + ' doesn\'t exist in the server\'s XML '
+                                   'file\n')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()